@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import argparse
+import numpy as np
+import time
+import resource
+
+import DownloadDB
+from mpi4py import MPI
+
+
+def SetupParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( "-n", "--nlocks", help="Lock/unlock cycles per worker rank", default=1000, type=int)
+    parser.add_argument( "-w", "--hold", help="Seconds to hold each lock (stand-in for the write)", default=0.0, type=float)
+    parser.add_argument( "-p", "--poll", help="Seconds to sleep between MPI probes while waiting (0 blocks in recv)", default=0.001, type=float)
+    return parser
+
+
+def ParseArgs(parser):
+    args = parser.parse_args()
+    return args
+
+def GetArgs():
+    parser = SetupParser()
+    args = ParseArgs(parser)
+    return args
+
+
+def CPU():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime
+
+
+def Bench(args, rank):
+    waits = np.zeros(args.nlocks)
+    nums = np.random.randint(0, 4, size=args.nlocks)
+    for i in range(args.nlocks):
+        start = time.time()
+        DownloadDB.Acquire(nums[i], rank, args)
+        waits[i] = time.time() - start
+        if args.hold > 0:
+            time.sleep(args.hold)
+        DownloadDB.Release(nums[i], rank)
+
+    # Ask for a chunk, as DownloadDB's workers do, so Serve() sees every rank finish
+    MPI.COMM_WORLD.send([rank, 0], dest=0)
+    DownloadDB.Receive(0, args.poll)
+    return waits
+
+
+def Serve(args):
+    # DownloadDB's lock grants without the chunk queue and writers
+    rsize = MPI.COMM_WORLD.size - 1
+    rdone = 0
+    wait = [ [],[],[],[] ]
+    while (rdone < rsize):
+        rank, msg = DownloadDB.Receive(MPI.ANY_SOURCE, args.poll)
+        if msg==0:
+            MPI.COMM_WORLD.send(-1, dest=rank)
+            rdone += 1
+        else:
+            DownloadDB.Grant(wait, rank, msg)
+
+
+if __name__=='__main__': 
+    args = GetArgs()
+    rank = MPI.COMM_WORLD.Get_rank()
+    size = MPI.COMM_WORLD.size
+
+    MPI.COMM_WORLD.Barrier()
+    start = time.time()
+    cpu = CPU()
+    if rank==0:
+        Serve(args)
+        waits = np.zeros(0)
+    else:
+        waits = Bench(args, rank)
+    wall = time.time() - start
+    cpu = CPU() - cpu
+
+    waits = MPI.COMM_WORLD.gather(waits, root=0)
+    if rank==0:
+        waits = np.concatenate(waits)
+        print 'ranks=%i locks=%i wall=%.3f locks/s=%.1f wait_mean=%.6f wait_p50=%.6f wait_p99=%.6f rank0_cpu=%.3f' %(size, len(waits), wall, len(waits)/wall, np.mean(waits), np.percentile(waits,50), np.percentile(waits,99), cpu/wall)
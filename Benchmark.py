@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+import argparse
+import numpy as np
+import os
+import sys
+import json
+import time
+import resource
+import subprocess
+
+import FakeDB
+import SchemaCache
+import Events
+
+
+def SetupParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( "-tl", "--tool", help="Tool to benchmark", default='download', choices=['download', 'partition', 'index'])
+    parser.add_argument( "-np", "--ranks", help="MPI rank counts to run at", default='2,5,11')
+    parser.add_argument( "-od", "--dir", help="Directory for the database, outputs and results", default='bench')
+    parser.add_argument( "-x", "--extra", help="Extra arguments passed to the tool", default='')
+    parser.add_argument( "-mp", "--mpirun", help="MPI launcher", default='mpirun')
+
+    parser.add_argument( "-t", "--table", help="Synthetic Balrog table name", default='balrog_bench')
+    parser.add_argument( "-nt", "--ntiles", help="Number of tiles", default=200, type=int)
+    parser.add_argument( "-rt", "--rows", help="Median truth rows per tile (tiles scatter lognormally around it)", default=1000, type=int)
+    parser.add_argument( "-s", "--seed", help="Random seed for the synthetic tables", default=0, type=int)
+    parser.add_argument( "-g", "--generate", help="Regenerate the synthetic tables even if the database exists", action="store_true")
+    return parser
+
+
+def ParseArgs(parser):
+    args = parser.parse_args()
+    args.ranks = [int(n) for n in args.ranks.split(',')]
+    args.fakedb = os.path.join(args.dir, '%s.sqlite'%(args.table))
+    args.schema = os.path.join(args.dir, 'schema-cache.json')
+    args.user = 'bench'
+    args.destable = '%s_coadd_objects'%(args.table)
+    return args
+
+def GetArgs():
+    parser = SetupParser()
+    args = ParseArgs(parser)
+    return args
+
+
+bands = ['g','r','i','z','y']
+
+def Columns(kind):
+    if kind=='truth':
+        cols = [('balrog_index','number(12)'), ('tilename','varchar2(12)'), ('ra','binary_double'), ('dec','binary_double')]
+        cols += [('mag_%s'%(b),'binary_double') for b in bands] + [('not_drawn_%s'%(b),'number(5)') for b in bands]
+    elif kind in ['sim', 'nosim']:
+        cols = [('balrog_index','number(12)'), ('tilename','varchar2(12)'), ('number_sex','number(10)'), ('alphawin_j2000_i','binary_double'), ('deltawin_j2000_i','binary_double')]
+        cols += [('flux_auto_%s'%(b),'binary_double') for b in bands] + [('mag_auto_%s'%(b),'binary_double') for b in bands]
+    else:
+        cols = [('coadd_objects_id','number(12)'), ('tilename','varchar2(12)'), ('ra','binary_double'), ('dec','binary_double')]
+        cols += [('flux_auto_%s'%(b),'binary_double') for b in bands] + [('mag_auto_%s'%(b),'binary_double') for b in bands]
+    return cols
+
+
+def Fill(cols, tile, ids, ra, dec, rng):
+    rows = []
+    for name, decl in cols:
+        if name in ['balrog_index', 'coadd_objects_id']:
+            rows.append(ids)
+        elif name=='tilename':
+            rows.append([tile]*len(ids))
+        elif name in ['ra', 'alphawin_j2000_i']:
+            rows.append(ra + rng.normal(0, 1e-5, len(ids)))
+        elif name in ['dec', 'deltawin_j2000_i']:
+            rows.append(dec + rng.normal(0, 1e-5, len(ids)))
+        elif name.startswith('not_drawn'):
+            rows.append(rng.randint(0, 2, len(ids)))
+        elif name.startswith('mag'):
+            rows.append(rng.uniform(18, 26, len(ids)))
+        elif name.startswith('flux'):
+            rows.append(rng.lognormal(5, 2, len(ids)))
+        else:
+            rows.append(rng.randint(0, 10000, len(ids)))
+    return zip(*[np.asarray(r).tolist() for r in rows])
+
+
+def Generate(args):
+    # Per tile: truth rows scattered lognormally around --rows; about 90% of them detected in sim,
+    # 30% in nosim, and twice as many DES objects
+    if os.path.exists(args.fakedb):
+        os.remove(args.fakedb)
+    rng = np.random.RandomState(args.seed)
+    db = FakeDB.connect(args.fakedb).db
+    kinds = ['truth', 'sim', 'nosim', 'des']
+    names = ['%s_truth'%(args.table), '%s_sim'%(args.table), '%s_nosim'%(args.table), args.destable]
+    for kind, name in zip(kinds, names):
+        db.execute( 'create table %s (%s)'%(name, ', '.join(['%s %s'%(c, d) for c, d in Columns(kind)])) )
+
+    start = 0
+    for i in range(args.ntiles):
+        tile = 'DES%04i-%04i'%(i/100, i%100)
+        n = max(1, int(rng.lognormal(np.log(args.rows), 0.5)))
+        ra = rng.uniform(0, 0.7, n) + 0.7*(i%100)
+        dec = rng.uniform(0, 0.7, n) - 0.7*(i/100)
+        ids = np.arange(start, start+n)
+        start += n
+
+        for kind, name, frac in zip(kinds, names, [1.0, 0.9, 0.3, 2.0]):
+            cols = Columns(kind)
+            if kind=='des':
+                m = int(frac*n)
+                take = rng.randint(0, n, m)
+                rows = Fill(cols, tile, np.arange(i*10*args.rows, i*10*args.rows+m), ra[take], dec[take], rng)
+            else:
+                take = np.arange(n)
+                if frac < 1:
+                    take = take[rng.uniform(size=n) < frac]
+                rows = Fill(cols, tile, ids[take], ra[take], dec[take], rng)
+            db.executemany( 'insert into %s values (%s)'%(name, ', '.join(['?']*len(cols))), rows )
+    db.commit()
+    db.close()
+
+
+def Cache(args):
+    conn = FakeDB.connect(args.fakedb)
+    cache = {}
+    for table in ['truth', 'sim', 'nosim']:
+        name = '%s_%s'%(args.table, table)
+        cache[SchemaCache.Key(name, user=args.user)] = SchemaCache.ToJson( FakeDB.ColumnDescribe(conn, name) )
+    cache[SchemaCache.Key(args.destable)] = SchemaCache.ToJson( FakeDB.ColumnDescribe(conn, args.destable) )
+    conn.close()
+    SchemaCache.Save(args.schema, cache)
+
+
+def Rows(args):
+    conn = FakeDB.connect(args.fakedb)
+    n = {}
+    for table in ['truth', 'sim', 'nosim']:
+        n[table] = int( conn.quick('select count(*) n from %s_%s'%(args.table, table))['n'][0] )
+    conn.close()
+    return n
+
+
+def Command(args, ranks, out):
+    here = os.path.dirname(os.path.abspath(__file__))
+    if args.tool=='download':
+        cmd = [os.path.join(here, 'DownloadDB.py'), '--table', args.table, '--user', args.user, '--destable', args.destable, '--dir', out, '--name', args.table]
+    elif args.tool=='partition':
+        cmd = [os.path.join(here, 'Partition.py'), '--table', args.table, '--owner', args.user, '--user', args.user, '--out', '%s_part'%(args.table), '--create']
+    else:
+        cmd = [os.path.join(here, 'Index.py'), '--table', args.table]
+    cmd = [sys.executable] + cmd + ['--fakedb', args.fakedb] + args.extra.split()
+    if args.tool!='index':
+        cmd = [args.mpirun, '-np', str(ranks)] + cmd + ['--schema', args.schema]
+    return cmd
+
+
+def Run(args, ranks):
+    out = os.path.join(args.dir, '%s-np%i'%(args.tool, ranks))
+    if not os.path.exists(out):
+        os.makedirs(out)
+    log = open('%s.log'%(out), 'w')
+    t = time.time()
+    code = subprocess.call(Command(args, ranks, out), stdout=log, stderr=subprocess.STDOUT)
+    wall = time.time() - t
+    log.close()
+
+    result = {'tool':args.tool, 'ranks':ranks, 'wall':wall, 'code':code, 'ntiles':args.ntiles, 'rows_per_tile':args.rows}
+    if args.tool=='download':
+        events = Events.Read(out)
+        outputs = [e for e in events if e['event']=='output']
+        workers = [e for e in events if e['event']=='rank']
+        result['rows'] = sum([e['rows'] for e in outputs])
+        result['lock_wait'] = sum([e['wait'] for e in outputs])
+        result['rss'] = max([e['rss'] for e in workers] + [0])
+    else:
+        result['rows'] = sum(Rows(args).values())
+        result['lock_wait'] = 0.0
+        result['rss'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+        if args.tool=='index':
+            subprocess.call(Command(args, 1, out) + ['--drop'], stdout=open('%s.log'%(out), 'a'), stderr=subprocess.STDOUT)
+    result['rows_per_s'] = result['rows'] / max(wall, 1e-9)
+    return result
+
+
+if __name__=='__main__':
+    args = GetArgs()
+    if not os.path.exists(args.dir):
+        os.makedirs(args.dir)
+    if args.generate or (not os.path.exists(args.fakedb)):
+        Generate(args)
+    Cache(args)
+    print '%s: %s' %(args.fakedb, ', '.join(['%s %i'%(k, v) for k, v in sorted(Rows(args).items())]))
+
+    # Index.py is not an MPI program, one run is enough
+    ranks = args.ranks
+    if args.tool=='index':
+        ranks = [1]
+
+    results = open(os.path.join(args.dir, 'benchmark.jsonl'), 'a')
+    for n in ranks:
+        result = Run(args, n)
+        results.write('%s\n'%(json.dumps(result)))
+        results.flush()
+        print '%-9s np=%-4i %8.1f s %10i rows %9.0f rows/s  lock wait %7.1f s  peak %7.1f MB  exit %i' %(args.tool, n, result['wall'], result['rows'], result['rows_per_s'], result['lock_wait'], result['rss'], result['code'])
+    results.close()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+
+import argparse
+import numpy as np
+import os
+import glob
+
+import Formats
+import Spatial
+
+
+def SetupParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( "-f", "--file", help="Downloaded output file (e.g. y1a1_s82/y1a1_s82-truth.fits)", required=True)
+    parser.add_argument( "-ti", "--tile", help="Print the row ranges of this tile", default=None)
+    parser.add_argument( "-tb", "--table", help="Only use rows from this source table", default=None)
+    parser.add_argument( "-c", "--columns", help="Count the rows matching --tile/--table/--ra/--dec/--cone, reading these columns (comma separated)", default=None)
+    parser.add_argument( "-ra", "--ra", help="RA range lo,hi in degrees (lo > hi wraps through 0)", default=None)
+    parser.add_argument( "-dec", "--dec", help="Dec range lo,hi in degrees", default=None)
+    parser.add_argument( "-cn", "--cone", help="Cone ra,dec,radius in degrees", default=None)
+    parser.add_argument( "-cr", "--chunkrows", help="Most rows read at a time", default=1000000, type=int)
+    return parser
+
+
+def ParseArgs(parser):
+    args = parser.parse_args()
+    if args.columns is not None:
+        args.columns = args.columns.split(',')
+    for key in ['ra', 'dec', 'cone']:
+        if getattr(args, key) is not None:
+            setattr(args, key, [float(v) for v in getattr(args, key).split(',')])
+    return args
+
+def GetArgs():
+    parser = SetupParser()
+    args = ParseArgs(parser)
+    return args
+
+
+def Index(file, table=None):
+    # Entries without a tile are the baseline rows of outputs written before manifests existed
+    entries = []
+    for entry in Formats.ReadManifest(file):
+        if entry.get('tile') is None:
+            continue
+        if (table is not None) and (entry['table']!=table):
+            continue
+        entries.append(entry)
+    return entries
+
+
+def Coalesce(ranges):
+    out = []
+    for start, count in sorted(ranges):
+        if count==0:
+            continue
+        if (len(out) > 0) and (sum(out[-1])==start):
+            out[-1][1] += count
+        else:
+            out.append([start, count])
+    return out
+
+
+def Tiles(file, table=None):
+    tiles = {}
+    for entry in Index(file, table=table):
+        tiles[entry['tile']] = tiles.get(entry['tile'], []) + entry['rows']
+    for tile in tiles.keys():
+        tiles[tile] = Coalesce(tiles[tile])
+    return tiles
+
+
+def TileRanges(file, tile, table=None):
+    ranges = []
+    for entry in Index(file, table=table):
+        if entry['tile']==tile:
+            ranges = ranges + entry['rows']
+    return Coalesce(ranges)
+
+
+def TableIds(file):
+    ids = {}
+    for entry in Index(file):
+        if 'ids' not in entry:
+            continue
+        lo, hi = entry['ids']
+        if entry['table'] in ids:
+            lo = min(lo, ids[entry['table']][0])
+            hi = max(hi, ids[entry['table']][1])
+        ids[entry['table']] = [lo, hi]
+    return ids
+
+
+def ReadRanges(file, ranges, columns=None):
+    f = Formats.Open(file, 'r')
+    data = [Formats.Read(f, start, start+count, columns=columns) for start, count in Coalesce(ranges)]
+    if len(data)==0:
+        data = [ Formats.Read(f, 0, min(1,Formats.NumRows(f)), columns=columns)[:0] ]
+    Formats.Close(f)
+    return np.concatenate(data)
+
+
+def ReadTile(file, tile, table=None, columns=None):
+    return ReadRanges(file, TileRanges(file, tile, table=table), columns=columns)
+
+
+# Queries over a whole downloaded catalog. Select() reads only the row ranges the manifest says can match
+# and only the columns asked for, and yields the rows in chunks so memory stays bounded.
+kinds = ['truth', 'sim', 'nosim', 'des']
+
+def Catalog(dir, name=None):
+    # The output files of a DownloadDB.py run, by kind
+    if name is None:
+        name = '*'
+    truth = [file for file in glob.glob(os.path.join(dir, '%s-truth.*'%(name))) if Formats.Type(file) in ['.fits', '.h5', '.cols']]
+    if len(truth)!=1:
+        raise IOError('expected one truth output in %s, found %i'%(dir, len(truth)))
+    base, ext = os.path.splitext(truth[0])
+    base = base[:-len('truth')]
+    files = {}
+    for kind in kinds:
+        if os.path.exists('%s%s%s'%(base, kind, ext)):
+            files[kind] = '%s%s%s'%(base, kind, ext)
+    return files
+
+
+def Ranges(file, tiles=None, table=None):
+    # Rows that can match: those of the manifest entries for these tiles and table, and any baseline rows
+    # (written before manifests were kept), which the index cannot vouch for
+    f = Formats.Open(file, 'r')
+    nrows = Formats.NumRows(f)
+    Formats.Close(f)
+    entries = Formats.ReadManifest(file)
+    if len(entries)==0:
+        return [[0, nrows]]
+    ranges = []
+    for entry in entries:
+        if entry.get('tile') is None:
+            ranges = ranges + entry['rows']
+        elif ((tiles is None) or (entry['tile'] in tiles)) and ((table is None) or (entry['table']==table)):
+            ranges = ranges + entry['rows']
+    return Coalesce(ranges)
+
+
+def Intersect(a, b):
+    # Of two coalesced range lists
+    out = []
+    i = j = 0
+    while (i < len(a)) and (j < len(b)):
+        lo = max(a[i][0], b[j][0])
+        hi = min(sum(a[i]), sum(b[j]))
+        if hi > lo:
+            out.append([lo, hi-lo])
+        if sum(a[i]) < sum(b[j]):
+            i += 1
+        else:
+            j += 1
+    return out
+
+
+def Pieces(ranges, chunkrows):
+    pieces = []
+    for start, count in ranges:
+        for i in range(start, start+count, chunkrows):
+            pieces.append( (i, min(i+chunkrows, start+count)) )
+    return pieces
+
+
+def InRange(values, bounds, wrap=False):
+    lo, hi = bounds
+    if wrap and (lo > hi):
+        return (values >= lo) | (values <= hi)
+    return (values >= lo) & (values <= hi)
+
+
+def InDisc(ra, dec, disc):
+    r = np.radians
+    cos = np.sin(r(dec))*np.sin(r(disc[1])) + np.cos(r(dec))*np.cos(r(disc[1]))*np.cos(r(ra-disc[0]))
+    return cos >= np.cos(r(disc[2]))
+
+
+def Mask(f, start, stop, tiles=None, table=None, ra=None, dec=None, disc=None, radec=['ra','dec']):
+    # Row-level check of the filters, reading only their columns; None when there is nothing to check.
+    # des rows have no table column, for them the manifest alone decides.
+    names = Formats.Columns(f)
+    checks = []
+    if (tiles is not None) and ('tilename' in names):
+        checks.append( ('tilename', lambda v: np.in1d(np.char.strip(v), tiles)) )
+    if (table is not None) and ('table' in names):
+        checks.append( ('table', lambda v: np.char.strip(v)==table) )
+    if ra is not None:
+        checks.append( (radec[0], lambda v: InRange(v, ra, wrap=True)) )
+    if dec is not None:
+        checks.append( (radec[1], lambda v: InRange(v, dec)) )
+    if len(checks)==0 and (disc is None):
+        return None
+
+    names = set([name for name, check in checks])
+    if disc is not None:
+        names = names | set(radec)
+    data = Formats.Read(f, start, stop, columns=list(names))
+    keep = np.ones(stop-start, dtype=np.bool_)
+    for name, check in checks:
+        keep &= check(data[name])
+    if disc is not None:
+        keep &= InDisc(data[radec[0]], data[radec[1]], disc)
+    return keep
+
+
+def Select(file, columns=None, tiles=None, table=None, ra=None, dec=None, disc=None, radec=None, chunkrows=1000000):
+    # Yields the matching rows, reading at most chunkrows at a time: the filter columns first, then the
+    # requested columns of the pieces that have any matching rows. A box (ra/dec ranges) or cone
+    # (disc = ra, dec, radius in degrees) only reads the pixels of the HEALPix index (Spatial.py) it overlaps,
+    # when the index is on the radec columns. radec defaults to the file's own (Spatial.Positions), sorted or not.
+    if isinstance(tiles, basestring):
+        tiles = [tiles]
+    index = Spatial.ReadIndex(file)
+    f = Formats.Open(file, 'r')
+    ranges = Ranges(file, tiles=tiles, table=table)
+    region = (ra is not None) or (dec is not None) or (disc is not None)
+    if region and (radec is None):
+        radec = Spatial.Positions(f)
+    if region and (index is not None) and (list(index['radec'])==list(radec)) and (Spatial.hp is not None):
+        ranges = Intersect(ranges, Spatial.Region(index, Formats.NumRows(f), ra=ra, dec=dec, disc=disc))
+
+    try:
+        for start, stop in Pieces(ranges, chunkrows):
+            keep = Mask(f, start, stop, tiles=tiles, table=table, ra=ra, dec=dec, disc=disc, radec=radec)
+            if (keep is not None) and (not np.any(keep)):
+                continue
+            data = Formats.Read(f, start, stop, columns=columns)
+            if keep is not None:
+                data = data[keep]
+            yield data
+    finally:
+        Formats.Close(f)
+
+
+def Read(file, **kwargs):
+    # All of Select() at once
+    data = list( Select(file, **kwargs) )
+    if len(data)==0:
+        f = Formats.Open(file, 'r')
+        data = [ Formats.Read(f, 0, min(1,Formats.NumRows(f)), columns=kwargs.get('columns'))[:0] ]
+        Formats.Close(f)
+    return np.concatenate(data)
+
+
+def Join(sim, truth, prefix='truth_'):
+    # Inner join on balrog_id as a sorted merge; truth has one row per balrog_id. Truth columns the sim rows
+    # already carry are added with the prefix.
+    order = np.argsort(truth['balrog_id'], kind='mergesort')
+    ids = truth['balrog_id'][order]
+    pos = np.clip( np.searchsorted(ids, sim['balrog_id']), 0, max(len(ids)-1,0) )
+    match = np.zeros(len(sim), dtype=np.bool_)
+    if len(ids) > 0:
+        match = (ids[pos]==sim['balrog_id'])
+    sim = sim[match]
+    truth = truth[ order[pos[match]] ]
+
+    names = [name for name in truth.dtype.names if name!='balrog_id']
+    out = [name if (name not in sim.dtype.names) else '%s%s'%(prefix,name) for name in names]
+    data = np.empty(len(sim), dtype=[(name, sim.dtype[name]) for name in sim.dtype.names] + [(o, truth.dtype[name]) for o, name in zip(out, names)])
+    for name in sim.dtype.names:
+        data[name] = sim[name]
+    for o, name in zip(out, names):
+        data[o] = truth[name]
+    return data
+
+
+def Groups(file, tiles=None, table=None, chunkrows=1000000):
+    # (table, tiles) groups of about chunkrows rows, one table each, so balrog_ids are unique within a group.
+    # Without a full tile index everything is one group.
+    entries = Formats.ReadManifest(file)
+    if (len(entries)==0) or any([entry.get('tile') is None for entry in entries]):
+        return [(table, tiles)]
+    counts = {}
+    for entry in Index(file, table=table):
+        if (tiles is None) or (entry['tile'] in tiles):
+            key = (entry['table'], entry['tile'])
+            counts[key] = counts.get(key, 0) + sum([count for start, count in entry['rows']])
+
+    groups = []
+    n = 0
+    for key in sorted(counts.keys()):
+        if (len(groups)==0) or (groups[-1][0]!=key[0]) or (n+counts[key] > chunkrows):
+            groups.append( (key[0], []) )
+            n = 0
+        groups[-1][1].append(key[1])
+        n += counts[key]
+    return groups
+
+
+def SimTruth(dir, kind='sim', columns=None, truthcolumns=None, name=None, tiles=None, table=None, ra=None, dec=None, disc=None, radec=None, chunkrows=1000000):
+    # Yields sim (or nosim) rows joined to their truth rows, a group of tiles at a time; each group's truth rows
+    # are found through the truth file's tile index instead of a scan
+    files = Catalog(dir, name=name)
+    if isinstance(tiles, basestring):
+        tiles = [tiles]
+    if (columns is not None) and ('balrog_id' not in columns):
+        columns = columns + ['balrog_id']
+    if (truthcolumns is not None) and ('balrog_id' not in truthcolumns):
+        truthcolumns = truthcolumns + ['balrog_id']
+
+    for gtable, gtiles in Groups(files[kind], tiles=tiles, table=table, chunkrows=chunkrows):
+        truth = None
+        for sim in Select(files[kind], columns=columns, tiles=gtiles, table=gtable, ra=ra, dec=dec, disc=disc, radec=radec, chunkrows=chunkrows):
+            if len(sim)==0:
+                continue
+            if truth is None:
+                truth = Read(files['truth'], columns=truthcolumns, tiles=gtiles, table=gtable, chunkrows=chunkrows)
+            yield Join(sim, truth)
+
+
+if __name__=='__main__':
+    args = GetArgs()
+
+    ids = TableIds(args.file)
+    for table in sorted(ids.keys()):
+        print table, 'balrog_id', ids[table][0], ids[table][1]
+    print len(Tiles(args.file, table=args.table)), 'tiles'
+
+    if args.tile is not None:
+        ranges = TileRanges(args.file, args.tile, table=args.table)
+        print args.tile, sum([count for start, count in ranges]), 'rows in', ranges
+
+    if (args.columns is not None) or (args.ra is not None) or (args.dec is not None) or (args.cone is not None):
+        tiles = None
+        if args.tile is not None:
+            tiles = [args.tile]
+        n = 0
+        for data in Select(args.file, columns=args.columns, tiles=tiles, table=args.table, ra=args.ra, dec=args.dec, disc=args.cone, chunkrows=args.chunkrows):
+            n += len(data)
+        print n, 'rows match'
@@ -7,48 +7,89 @@ import re
 import Queue
 import time
 import os
+import glob
+import resource
+import collections
+import threading
+import copy
 
-import fitsio
 import esutil
 import numpy.lib.recfunctions as rec
 
-import suchyta_utils.system
 import suchyta_utils.db
 import suchyta_utils.mpi as mpi
 
+import cx_Oracle
 from mpi4py import MPI
 
+import Formats
+import SchemaCache
+import Events
+import FakeDB
+import Spatial
+
 
 def SetupParser():
     parser = argparse.ArgumentParser()
-    parser.add_argument( "-t", "--table", help="DB table name to download", required=True)
+    parser.add_argument( "-t", "--table", help="DB table name to download; a comma separated list downloads them all in one job, into the same outputs", required=True)
     parser.add_argument( "-d", "--destable", help="DES table name", default='y1a1_coadd_objects')
 
     parser.add_argument( "-u", "--user", help="User who owns the DB table", default=None)
     parser.add_argument( "-c", "--chunkby", help="Get data in chunks by this column name", default='tilename')
+    parser.add_argument( "-sm", "--small", help="Chunks with fewer truth+sim+nosim rows than this are batched into one query (0 to disable)", default=20000, type=int)
+    parser.add_argument( "-mb", "--maxbatch", help="Most chunks in one batched query", default=100, type=int)
+    parser.add_argument( "-lj", "--localjoin", help="Fetch truth once per chunk and join it to sim/nosim here instead of in the DB (sim/nosim must carry the chunk column)", action="store_true")
+    parser.add_argument( "-bg", "--big", help="Chunks with more truth rows than this are split into balrog_index ranges (0 to disable)", default=250000, type=int)
 
     parser.add_argument( "-b", "--bands", help="Bands to get (if they exist in a table)", default='g,r,i,z,y,det')
     parser.add_argument( "-dc", "--descols", help="DES column names", default='all')
     parser.add_argument( "-sc", "--simcols", help="sim column names", default='all')
     parser.add_argument( "-tc", "--truthcols", help="truth column names", default='all')
 
-    parser.add_argument( "-ft", "--filetype", help="output file type", default='.fits', choices=['.fits', '.h5'])
+    parser.add_argument( "-sd", "--schema", help="File caching the tables' column descriptions", default='schema-cache.json')
+    parser.add_argument( "-rs", "--refresh", help="Describe the tables again instead of trusting the schema cache", action="store_true")
+
+    parser.add_argument( "-ft", "--filetype", help="output file type", default='.fits', choices=['.fits', '.h5', '.cols'])
+    parser.add_argument( "-cp", "--compress", help="HDF5 compression filter (fitsio cannot tile-compress FITS tables, use .h5 for compressed outputs)", default=None, choices=['lzf', 'gzip'])
+    parser.add_argument( "-sf", "--shuffle", help="HDF5 byte-shuffle filter ahead of --compress, which usually compresses numeric columns much better", action="store_true")
+    parser.add_argument( "-hc", "--h5chunk", help="Rows per HDF5 chunk", default=65536, type=int)
+    parser.add_argument( "-nw", "--narrow", help="Store columns in the smallest dtype their DB precision/scale allows, e.g. NUMBER(4) as int16, NUMBER(5) as int32 and BINARY_FLOAT as float32", action="store_true")
+    parser.add_argument( "-dt", "--dtypes", help="File of 'column dtype' lines overriding --narrow's choices (e.g. mag_auto_i f4)", default=None)
     parser.add_argument( "-a", "--append", help="Append to the given data", action="store_true")
-    parser.add_argument( "-off", "--offset", help="Offset appended balrog_id, use if the tables' balrog_indexes overlap", action="store_true")
+    parser.add_argument( "-off", "--offset", help="Offset appended balrog_id, use if the tables' balrog_indexes overlap (with several --table, each one starts after the one before it)", action="store_true")
     parser.add_argument( "-od", "--dir", help="output directory", default=None)
     parser.add_argument( "-on", "--name", help="output directory", default=None)
 
+    parser.add_argument( "-fd", "--fakedb", help="Run against this SQLite file instead of the DB (see Benchmark.py)", default=None)
+    parser.add_argument( "-as", "--arraysize", help="Stream query results in fetchmany() batches of this many rows (0 reads whole results with cur.quick)", default=0, type=int)
+    parser.add_argument( "-mx", "--maxrows", help="Most rows of one query held in memory while streaming; larger results are written in pieces", default=200000, type=int)
+
+    parser.add_argument( "-pf", "--prefetch", help="Query the next chunk in a background thread while writing the current one, buffering at most this many pieces (0 to disable)", default=0, type=int)
+    parser.add_argument( "-pl", "--pool", help="DB connections per worker; a chunk's truth/sim/nosim/des queries run concurrently over them", default=1, type=int)
+    parser.add_argument( "-ss", "--sessions", help="Cap on DB sessions for the whole job, shrinks --pool to fit (0 for no cap)", default=0, type=int)
+
+    parser.add_argument( "-sh", "--shards", help="Each rank writes its own shard files, merged into the outputs at the end", action="store_true")
+    parser.add_argument( "-r", "--resume", help="Resume a crashed run from the output manifests (pass the same --append/--offset as before)", action="store_true")
+    parser.add_argument( "-sy", "--sync", help="Bring existing outputs up to date with the table: only new or changed tiles are downloaded, stale rows are removed", action="store_true")
+    parser.add_argument( "-bu", "--buffer", help="Bytes of rows buffered per output before they are appended in one write (0 writes every piece as it comes)", default=64*1024**2, type=int)
+    parser.add_argument( "-wr", "--writer", help="Rank 0 writes all the outputs, keeping them open for the run; workers send it their rows instead of taking the write locks", action="store_true")
+    parser.add_argument( "-mr", "--mergerows", help="Rows read from a shard at a time when merging", default=1000000, type=int)
+
+    parser.add_argument( "-sl", "--slowest", help="Chunks listed in the run report's slowest chunks", default=10, type=int)
+    parser.add_argument( "-p", "--poll", help="Seconds to sleep between MPI probes while waiting (0 blocks in recv)", default=0.001, type=float)
+
     return parser
 
 
 def ParseArgs(parser):
     args = parser.parse_args()
     args.bands = args.bands.split(',')
+    args.tables = args.table.split(',')
     if args.user is None:
         args.user = suchyta_utils.db.GetUser()
 
     if args.dir is None:
-        args.dir = args.table.lstrip('balrog_')
+        args.dir = args.tables[0].lstrip('balrog_')
         """
         if args.filetype=='.fits':
             args.dir = 'FITS'
@@ -56,12 +97,42 @@ def ParseArgs(parser):
             args.dir = 'HDF5'
         """
     if args.name is None:
-        args.name = args.table
+        args.name = args.tables[0]
 
     args.file = []
     for f in ['truth','sim','nosim','des']:
         args.file.append( os.path.join(args.dir, '%s-%s%s'%(args.name,f,args.filetype)) )
+    args.sharddir = os.path.join(args.dir, 'shards')
+    args.events = None
+    args.idle = 0.0
+    args.tableoffset = None
+    args.done = [set(), set(), set(), set()]
+    args.plan = None
+    args.tablecols = None
+    args.casts = None
+    args.writers = []
+    # Shards already have one writer each
+    args.writer = args.writer and (not args.shards)
+    if args.sync:
+        args.resume = True
 
+    # args itself describes the first table, Table() the others
+    Names(args, args.tables[0])
+
+    # Only rank 0 talks to the DB's dictionary views; everyone else gets its answer
+    if MPI.COMM_WORLD.Get_rank()==0:
+        args.tablecols = [ColumnSelects(Table(args, i)) for i in range(len(args.tables))]
+        if args.narrow:
+            args.casts = Casts(args)
+    args.tablecols = mpi.Broadcast(args.tablecols)
+    args.casts = mpi.Broadcast(args.casts)
+    args.cols = args.tablecols[0]
+
+    return args
+
+
+def Names(args, table):
+    args.table = table
 
     args.truth = '%s_truth'%(args.table)
     args.utruth = '%s.%s'%(args.user, args.truth)
@@ -72,9 +143,21 @@ def ParseArgs(parser):
     args.nosim = '%s_nosim'%(args.table)
     args.unosim = '%s.%s'%(args.user, args.nosim)
 
-    args.cols = ColumnSelects(args)
 
-    return args
+def Table(args, i):
+    # The args the chunks of the i-th --table run with; writers, events and the like are shared with args
+    tab = copy.copy(args)
+    Names(tab, args.tables[i])
+    if args.tablecols is not None:
+        tab.cols = args.tablecols[i]
+    if args.plan is not None:
+        tab.done = args.plan[i]['done']
+        tab.tableoffset = args.plan[i]['offset']
+    return tab
+
+
+def Tables(args):
+    return [Table(args, i) for i in range(len(args.tables))]
 
 def GetArgs():
     parser = SetupParser()
@@ -82,8 +165,8 @@ def GetArgs():
     return args
 
 
-def AllOrFile(what, cat, user, bands, veto=['SLROK_DET']):
-    cols = np.core.defchararray.upper( suchyta_utils.db.ColumnDescribe(cat, user=user)['column_name'] )
+def AllOrFile(what, cat, user, bands, veto=['SLROK_DET'], schema=None, refresh=False):
+    cols = np.core.defchararray.upper( SchemaCache.Describe(cat, user=user, file=schema, refresh=refresh)['column_name'] )
     if what!='all':
         newcols = np.loadtxt(what, dtype=np.str_)
         base = []
@@ -102,14 +185,103 @@ def AllOrFile(what, cat, user, bands, veto=['SLROK_DET']):
     return cols[cut]
 
 
+def Narrow(type, precision, scale):
+    # Smallest dtype holding every value of an Oracle column, None to keep what the fetch gives
+    type = type.upper()
+    if type=='BINARY_FLOAT':
+        return 'f4'
+    if (type=='NUMBER') and (precision > 0):
+        if scale==0:
+            for digits, dtype in [(2,'i1'), (4,'i2'), (9,'i4'), (18,'i8')]:
+                if precision <= digits:
+                    return dtype
+        elif precision <= 6:
+            return 'f4'
+    return None
+
+
+def SchemaCasts(cat, user, args):
+    casts = {}
+    arr = SchemaCache.Describe(cat, user=user, file=args.schema, refresh=args.refresh)
+    for name, type, precision, scale in zip(arr['column_name'], arr['data_type'], np.nan_to_num(arr['data_precision']), np.nan_to_num(arr['data_scale'])):
+        dtype = Narrow(type, int(precision), int(scale))
+        if dtype is not None:
+            casts[name.lower()] = dtype
+    return casts
+
+
+def Overrides(file):
+    casts = {}
+    for line in open(file):
+        line = line.split('#')[0].split()
+        if len(line)==2:
+            casts[line[0].lower()] = line[1]
+    return casts
+
+
+def Casts(args):
+    # Per output, column -> dtype from the tables' precision/scale, then --dtypes. sim/nosim rows carry the truth
+    # columns too. With several tables a column is only narrowed as far as all of them allow.
+    outputs = []
+    for i in range(len(args.tables)):
+        tab = Table(args, i)
+        truth = SchemaCasts(tab.truth, tab.user, tab)
+        sim = SchemaCasts(tab.sim, tab.user, tab)
+        sim.update(truth)
+        nosim = SchemaCasts(tab.nosim, tab.user, tab)
+        nosim.update(truth)
+        outputs.append( [truth, sim, nosim, SchemaCasts(tab.destable, None, tab)] )
+
+    casts = []
+    for num in range(len(args.file)):
+        cast = {}
+        for name in outputs[0][num].keys():
+            dtypes = [out[num].get(name) for out in outputs]
+            if None not in dtypes:
+                cast[name] = np.dtype( reduce(np.promote_types, dtypes) ).str
+        if args.dtypes is not None:
+            cast.update( Overrides(args.dtypes) )
+        casts.append(cast)
+    return casts
+
+
+def Cast(data, dtype):
+    # Field by field, by name (astype on structured arrays goes by position)
+    out = np.empty(len(data), dtype=dtype)
+    for name in out.dtype.names:
+        out[name] = data[name]
+    return out
+
+
+def Conform(data, dtype):
+    # Rows appended to an existing output take its numeric dtypes, whatever --narrow would pick. Byte order is
+    # ignored (fitsio reports big-endian), and text may widen but never be cut, nor columns come or go.
+    if sorted(dtype.names)!=sorted(data.dtype.names):
+        raise ValueError('rows with columns %s do not fit an output with columns %s' %(', '.join(data.dtype.names), ', '.join(dtype.names)))
+    fields = []
+    for name in dtype.names:
+        have = data.dtype[name]
+        want = dtype[name].newbyteorder('=')
+        if (have.kind in 'SU') or (want.kind in 'SU'):
+            if want.kind!=have.kind:
+                raise ValueError('column %s is %s in the output, not %s' %(name, dtype[name].str, have.str))
+            if want.itemsize < have.itemsize:
+                raise ValueError('column %s is %s in the output, too narrow for %s' %(name, dtype[name].str, have.str))
+        fields.append( (name, want) )
+    fields = np.dtype(fields)
+    if fields==data.dtype:
+        return data
+    return Cast(data, fields)
+
+
 def ColumnSelects(args):
-    truthcols = AllOrFile(args.truthcols, args.truth, args.user, args.bands)
+    truthcols = AllOrFile(args.truthcols, args.truth, args.user, args.bands, schema=args.schema, refresh=args.refresh)
    
-    simcols = AllOrFile(args.simcols, args.sim, args.user, args.bands)
+    simcols = AllOrFile(args.simcols, args.sim, args.user, args.bands, schema=args.schema, refresh=args.refresh)
     cut = -( np.in1d(simcols, truthcols) )
     simcols = simcols[cut]
 
-    descols = AllOrFile(args.descols, args.destable, None, args.bands)
+    descols = AllOrFile(args.descols, args.destable, None, args.bands, schema=args.schema, refresh=args.refresh)
     
     truthcols = ', '.join(np.core.defchararray.add('truth.',truthcols))
     simcols = ', '.join(np.core.defchararray.add('sim.',simcols))
@@ -119,15 +291,33 @@ def ColumnSelects(args):
 
 
 
-def Serve(chunks):
+def Connect(args):
+    if args.fakedb is not None:
+        return FakeDB.connect(args.fakedb)
+    return desdb.connect()
+
+
+def Receive(source, poll):
+    # Sleep between probes instead of spinning in a blocking recv, so an idle rank uses ~no CPU
+    if poll > 0:
+        while not MPI.COMM_WORLD.Iprobe(source=source):
+            time.sleep(poll)
+    return MPI.COMM_WORLD.recv(source=source)
+
+
+def Serve(args, chunks):
     rsize = MPI.COMM_WORLD.size - 1
     csize = len(chunks)
     sent = 0
     rdone = 0
     wait = [ [],[],[],[] ]
+    args.writers = Writers(args, 0)
+    args.tabs = Tables(args)
+    pending = {}
 
+    # A rank counts as done once it has flushed its buffers, which can still need the locks
     while (rdone < rsize):
-        rank, msg = MPI.COMM_WORLD.recv(source=MPI.ANY_SOURCE)
+        rank, msg = Receive(MPI.ANY_SOURCE, args.poll)
 
         if msg==0:
             if (sent < csize):
@@ -135,108 +325,873 @@ def Serve(chunks):
                 sent += 1
             else:
                 MPI.COMM_WORLD.send(-1, dest=rank)
-                rdone += 1
+
+        elif msg==-1:
+            rdone += 1
+
+        elif len(msg)==6:
+            # --writer: rows for rank 0 to buffer and write, manifest entries are kept here per chunk
+            num, table, label, data, units, last = msg
+            entries = pending.setdefault( (table,label,num), collections.OrderedDict() )
+            WriteData(data, args.tabs[table], num, units, entries, last, args.writers[num])
+            if last:
+                del pending[(table,label,num)]
+            if args.writers[num]['bytes'] >= args.buffer:
+                Flush(args, num, 0, args.writers[num])
 
         else:
-            for i in range(len(wait)):
-                if msg==(i,0):
-                    if rank not in wait[i]:
-                        wait[i].append(rank)
+            Grant(wait, rank, msg)
+
+    Finish(args, 0)
 
-                    if wait[i][0]==rank:
-                        MPI.COMM_WORLD.send(1, dest=rank)
-                    else:
-                        MPI.COMM_WORLD.send(0, dest=rank)
 
-                elif msg==(i,1):
-                    del wait[i][0]
+def Grant(wait, rank, msg):
+    # FIFO grant queue per output file: a rank asks once and is told only when it holds the lock
+    num, release = msg
+    if release:
+        del wait[num][0]
+        if len(wait[num]) > 0:
+            MPI.COMM_WORLD.send(1, dest=wait[num][0])
+    else:
+        wait[num].append(rank)
+        if len(wait[num])==1:
+            MPI.COMM_WORLD.send(1, dest=rank)
+
+
+def Next(args, rank):
+    t = time.time()
+    MPI.COMM_WORLD.send([rank, 0], dest=0)
+    chunk = Receive(0, args.poll)
+    args.idle += time.time() - t
+    return chunk
 
 
 def Work(args, rank):
-    cur = desdb.connect()
+    args.writers = Writers(args, rank)
+    args.tabs = Tables(args)
+    if (args.prefetch > 0) or (args.pool > 1):
+        Pipeline(args, rank)
+    else:
+        cur = Connect(args)
+        while True:
+            cmd = Next(args, rank)
+            if cmd==-1:
+                break
+            else:
+                GetData(args.tabs[cmd['table']], cmd, cur, rank)
+
+    Finish(args, rank)
+    MPI.COMM_WORLD.send([rank, -1], dest=0)
+
+
+def PoolSize(args):
+    pool = args.pool
+    if args.sessions > 0:
+        # Rank 0 holds one session of its own
+        pool = max(1, min(pool, (args.sessions-1) / max(1, MPI.COMM_WORLD.size-1)))
+    return pool
+
+
+def Fetcher(args, tasks, pieces):
+    # Runs the DB side of the pipeline; all MPI traffic and writes stay on the main thread
+    try:
+        cur = Connect(args)
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            tab, chunk, num, progress = task
+            tiles = Todo(tab, chunk, num)
+            for data, last in Events.Timed(OutputPieces(tab, chunk, num, cur, progress), progress['timing'][num]):
+                pieces.put( (chunk, num, tiles, data.copy(), last) )
+            pieces.put( (chunk, num, None, None, None) )
+    except Exception as e:
+        pieces.put(e)
+
+
+def Pipeline(args, rank):
+    pool = PoolSize(args)
+    tasks = Queue.Queue()
+    pieces = Queue.Queue(maxsize=max(args.prefetch, pool))
+    threads = []
+    for i in range(pool):
+        threads.append( threading.Thread(target=Fetcher, args=(args, tasks, pieces)) )
+        threads[-1].daemon = True
+        threads[-1].start()
+
+    # One chunk is written while the next one is queried; each output of a chunk is its own task
+    state = {}
+    more = True
     while True:
-        cmd = MPI.COMM_WORLD.sendrecv([rank, 0], dest=0, source=0)
-        if cmd==-1:
+        while more and (len(state) < 2):
+            chunk = Next(args, rank)
+            if chunk==-1:
+                more = False
+                for thread in threads:
+                    tasks.put(None)
+            else:
+                tab = args.tabs[chunk['table']]
+                progress = Progress()
+                progress['left'] = 0
+                state[(chunk['table'], Label(chunk))] = progress
+                for num in range(len(args.file)):
+                    if len(Todo(tab, chunk, num)) > 0:
+                        tasks.put( (tab, chunk, num, progress) )
+                        progress['left'] += 1
+        if len(state)==0:
             break
+
+        item = pieces.get()
+        if isinstance(item, Exception):
+            raise item
+        chunk, num, tiles, data, last = item
+        tab = args.tabs[chunk['table']]
+        progress = state[(chunk['table'], Label(chunk))]
+        if last is None:
+            progress['left'] -= 1
+            if progress['left']==0:
+                Report(tab, chunk, rank, state.pop((chunk['table'], Label(chunk))))
         else:
-            GetData(args, cmd, args.cols[0], args.cols[1], args.cols[2], cur, rank)
-            MPI.COMM_WORLD.send([rank, -1], dest=0)
+            Store(tab, chunk, rank, num, tiles, data, last, progress)
 
-def WaitOrWrite(num, rank, args, data):
-    while True:
-        msg = MPI.COMM_WORLD.sendrecv([rank,(num,0)], dest=0, source=0)
-        if msg==1:
-            WriteData(data,args,num)
-            MPI.COMM_WORLD.send([rank,(num,1)], dest=0)
-            break
+    for thread in threads:
+        thread.join()
+
+
+def Acquire(num, rank, args):
+    MPI.COMM_WORLD.send([rank,(num,0)], dest=0)
+    Receive(0, args.poll)
+
+
+def Release(num, rank):
+    MPI.COMM_WORLD.send([rank,(num,1)], dest=0)
+
+
+def Writers(args, rank):
+    # A writer that is the only one using its file keeps it open for the whole run: shards, and rank 0 with --writer
+    if args.shards:
+        return [Writer(file, True) for file in ShardFiles(args, rank)]
+    return [Writer(file, rank==0) for file in args.file]
+
+
+def Writer(file, own):
+    return {'file':file, 'own':own, 'f':None, 'pieces':[], 'bytes':0, 'newmax':None, 'raw':0, 'stored':0}
+
+
+def Output(num, rank, args, data, units, entries, last):
+    # Returns the seconds spent waiting for the lock (or, with --writer, handing the rows to rank 0)
+    if args.writer:
+        t = time.time()
+        MPI.COMM_WORLD.send([rank,(num, args.tables.index(args.table), units[0][0], data, units, last)], dest=0)
+        return time.time() - t
+    writer = args.writers[num]
+    WriteData(data, args, num, units, entries, last, writer)
+    if writer['bytes'] >= args.buffer:
+        return Flush(args, num, rank, writer)
+    return 0.0
+
+
+def Flush(args, num, rank, writer):
+    if len(writer['pieces'])==0:
+        return 0.0
+    wait = 0.0
+    if not writer['own']:
+        t = time.time()
+        Acquire(num, rank, args)
+        wait = time.time() - t
+    WriteBuffer(args, num, writer)
+    if not writer['own']:
+        Release(num, rank)
+    return wait
+
+
+def Finish(args, rank):
+    wait = 0.0
+    for num in range(len(args.writers)):
+        wait += Flush(args, num, rank, args.writers[num])
+        if args.writers[num]['raw'] > 0:
+            Events.Log(args.events, 'writer', rank=rank, num=num, raw=args.writers[num]['raw'], stored=args.writers[num]['stored'])
+        if args.writers[num]['f'] is not None:
+            Formats.Close(args.writers[num]['f'])
+            args.writers[num]['f'] = None
+    return wait
 
 
-def WriteData(data, args, num):
+def GetOffset(args, num):
+    # A synced table keeps the offset its rows were first written with
+    if (args.tableoffset is not None) and (num < 3):
+        return args.tableoffset
     offset = -1
-    file = args.file[num]
+    if args.append and args.offset and (num < 3):
+        f = Formats.Open(args.file[num], 'r')
+        offset = int( Formats.GetKey(f, 'max_id') )
+        Formats.Close(f)
+    return offset
 
-    if args.filetype=='.fits':
-        f = fitsio.FITS(file, 'rw')
-        if args.append:
-            h = f[1].read_header()
-            if args.offset and (num < 3):
-                offset = h['max_id']
 
+def WriteData(data, args, num, units, entries, last, writer):
+    # Rows are only buffered here; they reach the file, and their finished chunks the manifest, at the next WriteBuffer
+    offset = GetOffset(args, num)
     if num < 3:
         id = data['balrog_index'] + offset + 1
-        tab = np.array( [args.table]*len(data) )
+        # As wide as the longest --table, so every table's rows have the same columns
+        tab = np.array( [args.table]*len(data), dtype='S%i'%(max([len(table) for table in args.tables])) )
         data = rec.append_fields(data, ['balrog_id','table'], [id,tab])
+        if (num==0) and (len(data) > 0):
+            writer['newmax'] = max(writer['newmax'], int(np.amax(id)))
+    elif not data.flags['OWNDATA']:
+        # Streamed rows are a view of the fetch buffer, which is reused for the next piece
+        data = data.copy()
+    writer['raw'] += data.nbytes
+    if args.casts is not None:
+        dtype = np.dtype( [(name, args.casts[num].get(name, data.dtype[name])) for name in data.dtype.names] )
+        if dtype!=data.dtype:
+            data = Cast(data, dtype)
+    writer['stored'] += data.nbytes
+    writer['pieces'].append( {'table':args.table, 'offset':offset, 'data':data, 'units':units, 'entries':entries, 'last':last} )
+    writer['bytes'] += data.nbytes
 
-    new = False
-    if args.filetype=='.fits':
-        if len(f) < 2:
-            f.write(data)
-            f[1].write_key('newmax', offset)
-            new = True
-        else:
-            f[1].append(data)
 
+def WriteBuffer(args, num, writer):
+    # One append per run of buffered pieces with the same columns, then the header keys once, then the manifest
+    if writer['f'] is None:
+        writer['f'] = Formats.Open(writer['file'], 'rw')
+    f = writer['f']
+    first = Formats.NumRows(f)
+    pieces = writer['pieces']
+    finished = []
+    i = 0
+    while i < len(pieces):
+        j = i + 1
+        while (j < len(pieces)) and (pieces[j]['data'].dtype==pieces[i]['data'].dtype):
+            j += 1
+        data = [piece['data'] for piece in pieces[i:j] if len(piece['data']) > 0]
+        start = Formats.NumRows(f)
+        if len(data) > 0:
+            data = np.concatenate(data)
+            dtype = Formats.DType(f)
+            if dtype is not None:
+                data = Conform(data, dtype)
+            start = Append(args, f, data)
+        for piece in pieces[i:j]:
+            Entries(num, piece, start)
+            start += len(piece['data'])
+            if piece['last']:
+                finished = finished + piece['entries'].values()
+        i = j
+
+    SetMax(f, num, pieces[0]['offset'], first, writer['newmax'])
+    Formats.Flush(f)
+    Formats.Sync(writer['file'])
+    Formats.AddManifest(writer['file'], finished)
+    if not writer['own']:
+        Formats.Close(f)
+        writer['f'] = None
+    writer['pieces'] = []
+    writer['bytes'] = 0
+
+
+def Entries(num, piece, start):
+    # A chunk can arrive in several pieces; its manifest entries are written with the last one
+    data = piece['data']
+    entries = piece['entries']
+    for key, tile, first, count in piece['units']:
+        if key not in entries:
+            entries[key] = {'table':piece['table'], 'chunk':key, 'tile':tile, 'rows':[]}
+            if num < 3:
+                entries[key]['offset'] = piece['offset']
+                entries[key]['sum'] = 0
+        entry = entries[key]
+        if count > 0:
+            Formats.AddRows(entry, start+first, count)
+            if num < 3:
+                ids = data['balrog_id'][first:(first+count)]
+                ids = [int(np.amin(ids)), int(np.amax(ids))]
+                if 'ids' in entry:
+                    ids = [min(entry['ids'][0], ids[0]), max(entry['ids'][1], ids[1])]
+                entry['ids'] = ids
+                entry['sum'] += int( np.sum(data['balrog_index'][first:(first+count)]) )
+
+
+def Append(args, f, data):
+    return Formats.Append(f, data, compress=args.compress, chunkrows=args.h5chunk, shuffle=args.shuffle)
+
+
+def SetMax(f, num, offset, first, newmax):
+    # newmax, the largest truth balrog_id written so far, starts at the offset and is only raised
+    if first==0:
+        Formats.SetKey(f, 'newmax', offset)
+    if (num==0) and (newmax is not None) and (newmax > Formats.GetKey(f, 'newmax')):
+        Formats.SetKey(f, 'newmax', newmax)
+
+
+def Manifested(file):
+    # Without a manifest nothing says which rows of an output are whose, and Keep() would remove them all
+    if os.path.exists(file) and (not os.path.exists(Formats.ManifestFile(file))):
+        raise ValueError('%s has no manifest (written before manifests were kept), so it cannot be resumed or synced; download it again, or add to it with --append' %(file))
+
+
+def Recover(args, num, file):
+    # Remove rows no manifest entry accounts for, i.e. writes of chunks that never finished
+    Manifested(file)
+    entries = Formats.ReadManifest(file)
+    nrows = 0
+    if os.path.exists(file):
+        f = Formats.Open(file, 'r')
+        nrows = Formats.NumRows(f)
+        Formats.Close(f)
+    entries = [e for e in entries if all([start+count <= nrows for start, count in e['rows']])]
+    return Keep(args, num, file, entries)
+
+
+def Keep(args, num, file, entries):
+    # Keep only the rows of these entries, closing the gaps, and rewrite the manifest to match
+    nrows = 0
+    if os.path.exists(file):
+        f = Formats.Open(file, 'rw')
+        nrows = Formats.NumRows(f)
+
+    if nrows > 0:
+        keep = np.zeros(nrows, dtype=np.bool_)
+        for entry in entries:
+            for start, count in entry['rows']:
+                keep[start:(start+count)] = True
+        bad = np.where(~keep)[0]
+
+        if len(bad) > 0:
+            print 'removing %i rows from %s' %(len(bad), file)
+            # Row ranges move, so a HEALPix index of the file no longer holds
+            Formats.Remove(Spatial.IndexFile(file))
+            if bad[0]==(nrows-len(bad)):
+                Formats.Resize(f, bad[0])
+            else:
+                Formats.DeleteRows(f, bad)
+            for entry in entries:
+                for rows in entry['rows']:
+                    rows[0] = rows[0] - int(np.searchsorted(bad, rows[0]))
         if num==0:
-            newmax = np.amax(data['balrog_id'])
-            h = f[1].read_header()
-            oldmax = h['newmax']
-            if newmax > oldmax:
-                f[1].write_key('newmax', newmax)
+            newmax = max( [GetOffset(args, num)] + [e['ids'][1] for e in entries if 'ids' in e] )
+            Formats.SetKey(f, 'newmax', newmax)
+    if os.path.exists(file):
+        Formats.Close(f)
+    Formats.AddManifest(file, entries, mode='w')
+    return entries
 
 
-def GetData(args, chunk, truthcols, simcols, descols, cur, rank):
-    if type(chunk)==np.str_:
-        chunk = "'%s'"%(chunk)
+def Resume(args):
+    # Finished chunks of every table in each output, keyed by table
+    done = {}
+    for num in range(len(args.file)):
+        files = [args.file[num]]
+        if args.shards:
+            files = files + ListShards(args, num)
+        for file in files:
+            for entry in Recover(args, num, file):
+                done.setdefault(entry['table'], [set(), set(), set(), set()])[num].add(entry['chunk'])
+    return done
 
-    q = "select %s from %s truth where truth.%s=%s order by truth.balrog_index"%(truthcols, args.utruth, args.chunkby, chunk)
-    data = cur.quick(q, array=True)
-    t = len(data)
-    WaitOrWrite(0, rank, args, data)
 
-    q = "select %s, %s from %s sim, %s truth where truth.%s=%s and truth.balrog_index=sim.balrog_index order by truth.balrog_index"%(simcols, truthcols, args.usim, args.utruth, args.chunkby, chunk)
-    data = cur.quick(q, array=True)
-    s = len(data)
-    WaitOrWrite(1, rank, args, data)
+def Signature(args, entries):
+    # Per tile: rows, and where every entry has them, the largest and summed balrog_index
+    sigs = {}
+    for entry in entries:
+        if (entry['table']!=args.table) or (entry['tile'] is None):
+            continue
+        sig = sigs.setdefault(entry['tile'], {'n':0, 'hi':-1, 's':0})
+        sig['n'] += sum([count for start, count in entry['rows']])
+        if ('offset' not in entry) or ('hi' not in sig):
+            sig.pop('hi', None)
+            sig.pop('s', None)
+        else:
+            if 'ids' in entry:
+                sig['hi'] = max(sig['hi'], entry['ids'][1]-entry['offset']-1)
+            sig['s'] += entry['sum']
+    return sigs
 
-    q = "select %s, %s from %s sim, %s truth where truth.%s=%s and truth.balrog_index=sim.balrog_index order by truth.balrog_index"%(simcols, truthcols, args.unosim, args.utruth, args.chunkby, chunk)
-    data = cur.quick(q, array=True)
-    n = len(data)
-    WaitOrWrite(2, rank, args, data)
 
-    q = "select %s from %s des where des.%s=%s"%(descols, args.destable, args.chunkby, chunk)
-    data = cur.quick(q, array=True)
-    d = len(data)
-    WaitOrWrite(3, rank, args, data)
+def Aggregates(args, cur):
+    # The same signatures from the DB, one grouped query per output; sim/nosim count what the join returns
+    c = args.chunkby
+    qs = ["select truth.%s tile, count(*) n, max(truth.balrog_index) hi, sum(truth.balrog_index) s from %s truth group by truth.%s"%(c, args.utruth, c)]
+    for table in [args.usim, args.unosim]:
+        qs.append( "select truth.%s tile, count(*) n, max(sim.balrog_index) hi, sum(sim.balrog_index) s from %s sim, %s truth where truth.balrog_index=sim.balrog_index group by truth.%s"%(c, table, args.utruth, c) )
+    qs.append( "select des.%s tile, count(*) n from %s des where des.%s in (select %s from %s) group by des.%s"%(c, args.destable, c, c, args.utruth, c) )
 
-    print chunk, t, n, s, d, suchyta_utils.system.GetMaxMemoryUsage()
+    sigs = []
+    for q in qs:
+        arr = cur.quick(q, array=True)
+        sig = {}
+        for i in range(len(arr)):
+            sig[arr['tile'][i]] = dict( [(name, int(arr[name][i])) for name in arr.dtype.names if name!='tile'] )
+        sigs.append(sig)
+    return sigs
 
 
-def FileSetup(args):
+def Sync(args, cur):
+    # Compares what the outputs hold for this table against the DB tile by tile. Changed or vanished tiles
+    # have their rows removed; done is every tile still in step, so only new and changed tiles are fetched.
+    remote = Aggregates(args, cur)
+    files = []
+    local = []
+    stale = []
+    offsets = []
+    for num in range(len(args.file)):
+        files.append( [args.file[num]] )
+        if args.shards:
+            files[num] = files[num] + ListShards(args, num)
+        entries = []
+        for file in files[num]:
+            Manifested(file)
+            entries = entries + Formats.ReadManifest(file)
+        offsets = offsets + [e['offset'] for e in entries if (e['table']==args.table) and ('offset' in e)]
+        local.append( Signature(args, entries) )
+
+        stale.append(set())
+        for tile, sig in local[num].items():
+            # Tiles with no rows in an output are missing from its aggregate
+            other = remote[num].get(tile, {'n':0})
+            if any([sig[k]!=other[k] for k in sig.keys() if k in other]):
+                stale[num].add(tile)
+
+    # sim and nosim rows carry truth columns, so a changed truth tile is refetched everywhere
+    for num in [1,2]:
+        stale[num] = stale[num] | stale[0]
+
+    done = []
+    for num in range(len(args.file)):
+        if len(stale[num]) > 0:
+            for file in files[num]:
+                Keep(args, num, file, [e for e in Formats.ReadManifest(file) if (e['table']!=args.table) or (e['tile'] not in stale[num])])
+        done.append( set(local[num].keys()) - stale[num] )
+        print '%s: %i tiles current, %i stale, %i new' %(os.path.basename(args.file[num]), len(done[num]), len(stale[num]), len(set(remote[num].keys())-set(local[num].keys())))
+
+    offset = None
+    if len(offsets) > 0:
+        offset = offsets[0]
+    return done, offset
+
+
+def ShardFiles(args, rank):
+    files = []
     for file in args.file:
-        if (not args.append) and (os.path.exists(file)):
-            os.remove(file)
+        name, ext = os.path.splitext( os.path.basename(file) )
+        files.append( os.path.join(args.sharddir, '%s-%i%s'%(name, rank, ext)) )
+    return files
+
+
+def ListShards(args, num):
+    name, ext = os.path.splitext( os.path.basename(args.file[num]) )
+    manifests = glob.glob( Formats.ManifestFile(os.path.join(args.sharddir, '%s-*%s'%(name, ext))) )
+    shards = [ m[:-len(Formats.ManifestFile(''))] for m in manifests ]
+    ranks = [ int(os.path.splitext(s)[0].rsplit('-',1)[-1]) for s in shards ]
+    return [ shards[i] for i in np.argsort(ranks) ]
+
+
+def MergeShards(args, rank):
+    # Each output is merged by a different rank, so the four merges run concurrently
+    MPI.COMM_WORLD.Barrier()
+    for num in range(rank, len(args.file), MPI.COMM_WORLD.size):
+        offset = GetOffset(args, num)
+        file = args.file[num]
+        merged = set( [(e['table'], e['chunk']) for e in Formats.ReadManifest(file)] )
+
+        for shard in ListShards(args, num):
+            entries = [e for e in Formats.ReadManifest(shard) if (e['table'], e['chunk']) not in merged]
+            if any([len(e['rows']) > 0 for e in entries]):
+                out = Formats.Open(file, 'rw')
+                first = Formats.NumRows(out)
+                f = Formats.Open(shard, 'r')
+                for entry in entries:
+                    ranges = entry['rows']
+                    entry['rows'] = []
+                    for start, count in ranges:
+                        for i in range(start, start+count, args.mergerows):
+                            data = Formats.Read(f, i, min(i+args.mergerows, start+count))
+                            Formats.AddRows(entry, Append(args, out, data), len(data))
+                Formats.Close(f)
+                SetMax(out, num, offset, first, max([None] + [e['ids'][1] for e in entries if 'ids' in e]))
+                Formats.Close(out)
+                # Shard rows are only recorded as merged once they are on disk in the output
+                Formats.Sync(file)
+            Formats.AddManifest(file, entries)
+            Formats.Remove(shard)
+            Formats.Remove(Formats.ManifestFile(shard))
+    MPI.COMM_WORLD.Barrier()
+
+
+def Key(chunk, tile):
+    if chunk['range'] is None:
+        return str(tile)
+    return '%s:%i-%i'%(tile, chunk['range'][0], chunk['range'][1])
+
+
+def Label(chunk):
+    label = Key(chunk, chunk['tiles'][0])
+    if len(chunk['tiles']) > 1:
+        label = '%s+%i'%(label, len(chunk['tiles'])-1)
+    return label
+
+
+def Todo(args, chunk, num):
+    # Only the first balrog_index range of a split tile fetches its DES objects; a bare tile in done covers all its ranges
+    if (num==3) and (not chunk['des']):
+        return []
+    return [tile for tile in chunk['tiles'] if (Key(chunk, tile) not in args.done[num]) and (tile not in args.done[num])]
+
+
+def Batchable(args):
+    cols = [args.cols[0].split(', '), args.cols[2].split(', ')]
+    return ('truth.%s'%(args.chunkby.upper()) in cols[0]) and ('des.%s'%(args.chunkby.upper()) in cols[1])
+
+
+def Schedule(args, cur):
+    # Largest first, so the long chunks do not end up as stragglers at the end of the run
+    chunks = Chunks(args, cur)
+    chunks.sort(key=lambda c: c[0], reverse=True)
+    return [c[1] for c in chunks]
+
+
+def Recorded(args):
+    # balrog_index ranges of the split tiles in done, in any output, by tile
+    recorded = {}
+    for done in args.done:
+        for key in done:
+            tile, sep, span = str(key).rpartition(':')
+            if sep!='':
+                recorded.setdefault(tile, set()).add( tuple([int(v) for v in span.split('-')]) )
+    return recorded
+
+
+def Spans(lo, hi, k, recorded):
+    # [lo, hi) in k ranges, or the recorded ranges and the gaps between them cut in proportion
+    spans = sorted(recorded)
+    out = [list(span) for span in spans]
+    start = lo
+    for a, b in spans + [(hi, hi)]:
+        if a > start:
+            n = max( -(-(a-start)*k // (hi-lo)), 1 )
+            edges = np.linspace(start, a, n+1).astype(np.int64)
+            out += [[int(edges[i]), int(edges[i+1])] for i in range(n)]
+        start = max(start, b)
+    return sorted(out)
+
+
+def Chunks(args, cur):
+    # (cost, chunk) pairs of one table
+    q = "select %s tile, count(*) n, min(balrog_index) lo, max(balrog_index) hi from %s group by %s"%(args.chunkby, args.utruth, args.chunkby)
+    truth = cur.quick(q, array=True)
+    cost = dict( zip(truth['tile'].tolist(), truth['n'].tolist()) )
+    for table in [args.usim, args.unosim]:
+        q = "select %s tile, count(*) n from %s group by %s"%(args.chunkby, table, args.chunkby)
+        counts = cur.quick(q, array=True)
+        for tile, n in zip(counts['tile'].tolist(), counts['n'].tolist()):
+            if tile in cost:
+                cost[tile] += n
+
+    small = args.small
+    if (small > 0) and (not Batchable(args)):
+        print 'not batching small chunks, %s is not in the truth and DES columns' %(args.chunkby)
+        small = 0
+
+    # A tile split by an earlier run keeps the ranges it recorded, whatever --big is now
+    recorded = Recorded(args)
+    chunks = []
+    batch = []
+    for tile, n, lo, hi in zip(truth['tile'].tolist(), truth['n'].tolist(), truth['lo'].tolist(), truth['hi'].tolist()):
+        k = 1
+        if args.big > 0:
+            k = int( np.ceil(float(n)/args.big) )
+
+        if (k > 1) or (str(tile) in recorded):
+            spans = Spans(lo, hi+1, k, recorded.get(str(tile), []))
+            des = [i for i in range(len(spans)) if Key({'range':spans[i]}, tile) in args.done[3]] + [0]
+            for i in range(len(spans)):
+                chunk = {'tiles':[tile], 'range':spans[i], 'des':(i==des[0])}
+                chunks.append( [cost[tile]*float(spans[i][1]-spans[i][0])/(hi+1-lo), chunk] )
+        else:
+            chunk = {'tiles':[tile], 'range':None, 'des':True}
+            if cost[tile] < small:
+                batch.append( [cost[tile], chunk] )
+            else:
+                chunks.append( [cost[tile], chunk] )
+
+    chunks = [c for c in chunks if not Done(args, c[1])]
+    batch = [c for c in batch if not Done(args, c[1])]
+
+    # Pack the small tiles, biggest first, into IN (...) queries of about --small rows each
+    batch.sort(key=lambda c: c[0], reverse=True)
+    batches = []
+    for n, chunk in batch:
+        if (len(batches)==0) or (batches[-1][0]+n > small) or (len(batches[-1][1]['tiles']) >= args.maxbatch):
+            batches.append( [n, chunk] )
+        else:
+            batches[-1][0] += n
+            batches[-1][1]['tiles'] += chunk['tiles']
+    return chunks + batches
+
+
+def Plan(args, cur):
+    # Every table's finished chunks and balrog_id offset are worked out before the run, and the chunks of all
+    # the tables go into one queue. With --offset each table starts after the balrog_indexes of the one before.
+    resumed = {}
+    if args.resume:
+        resumed = Resume(args)
+    plan = []
+    chunks = []
+    for i in range(len(args.tables)):
+        tab = Table(args, i)
+        tab.done = resumed.get(tab.table, [set(), set(), set(), set()])
+        if args.sync:
+            tab.done, tab.tableoffset = Sync(tab, cur)
+        if tab.tableoffset is None:
+            if i==0:
+                tab.tableoffset = GetOffset(tab, 0)
+            elif args.offset:
+                tab.tableoffset = plan[-1]['offset'] + hi + 1
+            else:
+                tab.tableoffset = -1
+        elif (i > 0) and args.offset and (plan[-1]['offset'] + hi >= tab.tableoffset):
+            # A synced table keeps its offset, so one before it that grew upstream would write the same balrog_ids
+            raise ValueError('%s now reaches balrog_id %i, past the offset %i %s was written with; download them again without --sync' %(args.tables[i-1], plan[-1]['offset']+hi+1, tab.tableoffset, tab.table))
+        hi = int( cur.quick("select max(balrog_index) hi from %s"%(tab.utruth), array=True)['hi'][0] )
+        plan.append( {'done':tab.done, 'offset':tab.tableoffset} )
+
+        for cost, chunk in Chunks(tab, cur):
+            chunk['table'] = i
+            chunks.append( [cost, chunk] )
+        if len(args.tables) > 1:
+            print '%s: balrog_id offset %i' %(tab.table, tab.tableoffset)
+
+    chunks.sort(key=lambda c: c[0], reverse=True)
+    return plan, [c[1] for c in chunks]
+
+
+def Done(args, chunk):
+    for num in range(len(args.file)):
+        if len(Todo(args, chunk, num)) > 0:
+            return False
+    return True
+
+
+def Quote(value):
+    if isinstance(value, basestring):
+        return "'%s'"%(value)
+    return str(value)
+
+
+def Where(args, alias, tiles, bounds=None):
+    if len(tiles)==1:
+        where = "%s.%s=%s"%(alias, args.chunkby, Quote(tiles[0]))
+    else:
+        where = "%s.%s in (%s)"%(alias, args.chunkby, ', '.join([Quote(tile) for tile in tiles]))
+    if bounds is not None:
+        where = "%s and %s.balrog_index>=%i and %s.balrog_index<%i"%(where, alias, bounds[0], alias, bounds[1])
+    return where
+
+
+def OrderBy(args, alias, tiles, index=True):
+    # Batched queries come back tile by tile, so streamed pieces hold whole runs of a tile
+    order = []
+    if len(tiles) > 1:
+        order.append('%s.%s'%(alias, args.chunkby))
+    if index:
+        order.append('%s.balrog_index'%(alias))
+    if len(order)==0:
+        return ''
+    return ' order by %s'%(', '.join(order))
+
+
+def Query(args, num, chunk, tiles, local=False):
+    truthcols, simcols, descols = args.cols
+    if num==0:
+        q = "select %s from %s truth where %s%s"%(truthcols, args.utruth, Where(args,'truth',tiles,chunk['range']), OrderBy(args,'truth',tiles))
+    elif (num < 3) and local:
+        table = [args.usim, args.unosim][num-1]
+        q = "select %s, sim.balrog_index from %s sim where %s%s"%(simcols, table, Where(args,'sim',tiles,chunk['range']), OrderBy(args,'sim',tiles))
+    elif num < 3:
+        table = [args.usim, args.unosim][num-1]
+        q = "select %s, %s from %s sim, %s truth where %s and truth.balrog_index=sim.balrog_index%s"%(simcols, truthcols, table, args.utruth, Where(args,'truth',tiles,chunk['range']), OrderBy(args,'truth',tiles))
+    else:
+        q = "select %s from %s des where %s%s"%(descols, args.destable, Where(args,'des',tiles), OrderBy(args,'des',tiles,index=False))
+    return q
+
+
+def Descr(description):
+    descr = []
+    for name, type, display, internal, precision, scale, nullable in description:
+        if (type==cx_Oracle.NUMBER) and (scale==0) and (precision > 0):
+            descr.append( (name.lower(), 'i8') )
+        elif type in [cx_Oracle.NUMBER, cx_Oracle.NATIVE_FLOAT]:
+            descr.append( (name.lower(), 'f8') )
+        else:
+            descr.append( (name.lower(), 'S%i'%(internal)) )
+    return descr
+
+
+def Fetch(args, cur, q):
+    # Yields (rows, last); while streaming the rows are a view of a reused buffer, valid until the next piece
+    if args.arraysize <= 0:
+        yield cur.quick(q, array=True), True
+        return
+
+    curs = cur.cursor()
+    curs.arraysize = min(args.arraysize, args.maxrows)
+    curs.execute(q)
+    buffer = np.empty(args.maxrows, dtype=Descr(curs.description))
+    n = 0
+    rows = curs.fetchmany()
+    while len(rows) > 0:
+        if n+len(rows) > len(buffer):
+            yield buffer[:n], False
+            n = 0
+        buffer[n:(n+len(rows))] = rows
+        n += len(rows)
+        rows = curs.fetchmany()
+    curs.close()
+    yield buffer[:n], True
+
+
+def PeakRSS():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def Split(args, data, chunk, tiles):
+    # Group the rows of a batched query by tile, so every tile gets its own manifest entry
+    if len(tiles)==1:
+        return data, [(Key(chunk, tiles[0]), tiles[0], 0, len(data))]
+
+    col = data[args.chunkby.lower()]
+    order = np.argsort(col, kind='mergesort')
+    data = data[order]
+    col = col[order]
+    units = []
+    for tile in tiles:
+        lo = np.searchsorted(col, tile, side='left')
+        hi = np.searchsorted(col, tile, side='right')
+        units.append( (Key(chunk, tile), tile, int(lo), int(hi-lo)) )
+    return data, units
+
+
+def Join(sim, truth):
+    # Inner join on balrog_index as a sorted merge; truth has one row per balrog_index
+    order = np.argsort(truth['balrog_index'], kind='mergesort')
+    index = truth['balrog_index'][order]
+    pos = np.clip( np.searchsorted(index, sim['balrog_index']), 0, max(len(index)-1,0) )
+    match = np.zeros(len(sim), dtype=np.bool_)
+    if len(index) > 0:
+        match = (index[pos]==sim['balrog_index'])
+    sim = sim[match]
+    truth = truth[ order[pos[match]] ]
+
+    names = [name for name in sim.dtype.names if name!='balrog_index']
+    dtype = [(name, sim.dtype[name]) for name in names] + [(name, truth.dtype[name]) for name in truth.dtype.names]
+    data = np.empty(len(sim), dtype=dtype)
+    for name in names:
+        data[name] = sim[name]
+    for name in truth.dtype.names:
+        data[name] = truth[name]
+    return data
+
+
+def Truth(args, chunk, cur, progress):
+    # With --localjoin the truth rows are fetched once per chunk, by whichever output needs them first
+    progress['lock'].acquire()
+    try:
+        if progress['truth'] is None:
+            tiles = []
+            for num in range(3):
+                tiles = tiles + [tile for tile in Todo(args, chunk, num) if tile not in tiles]
+            progress['truth'] = np.concatenate( [data.copy() for data, last in Fetch(args, cur, Query(args, 0, chunk, tiles))] )
+    finally:
+        progress['lock'].release()
+    return progress['truth']
+
+
+def OutputPieces(args, chunk, num, cur, progress):
+    tiles = Todo(args, chunk, num)
+    if args.localjoin and (num==0):
+        truth = Truth(args, chunk, cur, progress)
+        if len(tiles) < len(chunk['tiles']):
+            truth = truth[ np.in1d(truth[args.chunkby.lower()], tiles) ]
+        return [(truth, True)]
+    elif args.localjoin and (num < 3):
+        truth = Truth(args, chunk, cur, progress)
+        return ( (Join(data, truth), last) for data, last in Fetch(args, cur, Query(args, num, chunk, tiles, local=True)) )
+    return Fetch(args, cur, Query(args, num, chunk, tiles))
+
+
+def Pieces(args, chunk, cur, progress):
+    for num in range(len(args.file)):
+        tiles = Todo(args, chunk, num)
+        if len(tiles)==0:
+            continue
+        for data, last in Events.Timed(OutputPieces(args, chunk, num, cur, progress), progress['timing'][num]):
+            yield num, tiles, data, last
+
+
+def Progress():
+    return {'counts':[0,0,0,0], 'entries':[collections.OrderedDict() for i in range(4)], 'truth':None, 'lock':threading.Lock(),
+            'timing':[Events.Timing() for i in range(4)], 'start':time.time()}
+
+
+def Store(args, chunk, rank, num, tiles, data, last, progress):
+    data, units = Split(args, data, chunk, tiles)
+    progress['counts'][num] += len(data)
+    t = time.time()
+    wait = Output(num, rank, args, data, units, progress['entries'][num], last)
+    progress['timing'][num]['wait'] += wait
+    progress['timing'][num]['write'] += time.time() - t - wait
+
+
+def Report(args, chunk, rank, progress):
+    t, s, n, d = progress['counts']
+    label = Label(chunk)
+    if len(args.tables) > 1:
+        label = '%s %s'%(args.table, label)
+    print label, 'truth=%i sim=%i nosim=%i des=%i rss=%.1fMB' %(t, s, n, d, PeakRSS())
+
+    for num in range(len(args.file)):
+        if progress['timing'][num]['pieces'] > 0:
+            Events.Log(args.events, 'output', rank=rank, table=args.table, chunk=Label(chunk), tiles=Todo(args, chunk, num), num=num, **progress['timing'][num])
+    Events.Log(args.events, 'chunk', rank=rank, table=args.table, chunk=Label(chunk), rows=sum(progress['counts']), seconds=time.time()-progress['start'])
+
+
+def GetData(args, chunk, cur, rank):
+    progress = Progress()
+    for num, tiles, data, last in Pieces(args, chunk, cur, progress):
+        Store(args, chunk, rank, num, tiles, data, last, progress)
+    Report(args, chunk, rank, progress)
+
+
+def FileSetup(args):
     if not os.path.exists(args.dir):
         os.makedirs(args.dir)
+    for file in args.file:
+        Spatial.Recover(file)
+        if (not args.append) and (not args.resume):
+            Formats.Remove(file)
+            Formats.Remove(Spatial.IndexFile(file))
+            # An empty manifest, so a crash before the first entry still reads as a run of this kind
+            Formats.AddManifest(file, [], mode='w')
+        elif (not args.resume) and os.path.exists(file) and (not os.path.exists(Formats.ManifestFile(file))):
+            # Rows from before manifests were kept count as already written
+            f = Formats.Open(file, 'r')
+            entry = {'table':None, 'chunk':None, 'tile':None, 'rows':[[0,Formats.NumRows(f)]]}
+            if file==args.file[0]:
+                entry['ids'] = [None, int( Formats.GetKey(f, 'newmax') )]
+            Formats.Close(f)
+            Formats.AddManifest(file, [entry])
+
+    # Events describe one run, a resumed run starts a new log
+    Formats.Remove( Events.EventDir(args.dir) )
+    os.makedirs( Events.EventDir(args.dir) )
+
+    if args.shards:
+        if not args.resume:
+            for shard in glob.glob( os.path.join(args.sharddir, '*') ):
+                Formats.Remove(shard)
+        if not os.path.exists(args.sharddir):
+            os.makedirs(args.sharddir)
 
 
 if __name__=='__main__': 
@@ -245,22 +1200,44 @@ if __name__=='__main__':
     #chunks = truthcols = simcols = descols = None
   
     if rank==0:
-        print args.table
-        cur = desdb.connect()
-        chunks = cur.quick("select unique(%s) from %s"%(args.chunkby, args.utruth), array=True)['tilename']
+        print ', '.join(args.tables)
+        cur = Connect(args)
         FileSetup(args)
-        Serve(chunks)
+        args.plan, chunks = Plan(args, cur)
+        print '%i chunks to download' %(len(chunks))
+        if (args.prefetch > 0) or (args.pool > 1):
+            print '%i DB connections per worker' %(PoolSize(args))
+    args.plan = mpi.Broadcast(args.plan)
+    args.done = args.plan[0]['done']
+    args.tableoffset = args.plan[0]['offset']
+    args.events = Events.Open(args.dir, rank)
+    start = time.time()
+
+    if rank==0:
+        Serve(args, chunks)
     else:
         Work(args, rank)
+        Events.Log(args.events, 'rank', rank=rank, wall=time.time()-start, idle=args.idle, rss=PeakRSS())
+
+    if args.shards:
+        MergeShards(args, rank)
+    args.events.close()
 
+    rss = MPI.COMM_WORLD.gather(PeakRSS(), root=0)
     if rank==0:
+        print 'peak RSS per rank (MB): max %.1f (rank %i), mean %.1f' %(np.amax(rss), np.argmax(rss), np.mean(rss))
+        Events.Summary(Events.Read(args.dir), time.time()-start, slowest=args.slowest)
+        if args.shards:
+            os.rmdir(args.sharddir)
         for i in range(len(args.file)):
             if i==3:
                 break
-            f = fitsio.FITS(args.file[i], 'rw')
+            f = Formats.Open(args.file[i], 'rw')
             if i==0:
-                max = f[1].read_header()['newmax']
-            f[1].write_key('max_id', max)
+                max = Formats.GetKey(f, 'newmax')
+            Formats.SetKey(f, 'max_id', max)
+            Formats.Close(f)
+        print 'on disk (MB): %s' %(', '.join(['%s %.1f'%(Events.names[i], Formats.Size(args.file[i])/1024.0**2) for i in range(len(args.file)) if os.path.exists(args.file[i])]))
 
 
     #chunks = mpi.Scatter(chunks)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+import os
+import glob
+import json
+import time
+import numpy as np
+
+
+# Every rank appends JSON lines to its own file in <dir>/events: one 'output' event per chunk and
+# output (query/fetch/lock wait/write seconds, rows, bytes), one 'chunk' event when a chunk is finished,
+# one 'writer' event per output it wrote (bytes fetched and bytes stored after --narrow) and one 'rank'
+# event when the rank runs out of work.
+names = ['truth', 'sim', 'nosim', 'des']
+
+
+def EventDir(dir):
+    return os.path.join(dir, 'events')
+
+
+def EventFile(dir, rank):
+    return os.path.join(EventDir(dir), 'rank-%04i.jsonl'%(rank))
+
+
+def Open(dir, rank):
+    return open(EventFile(dir, rank), 'a')
+
+
+def Log(f, event, **fields):
+    if f is None:
+        return
+    fields['event'] = event
+    fields['time'] = time.time()
+    f.write('%s\n'%(json.dumps(fields)))
+    f.flush()
+
+
+def Read(dir):
+    events = []
+    for file in sorted( glob.glob(os.path.join(EventDir(dir), 'rank-*.jsonl')) ):
+        for line in open(file):
+            try:
+                events.append( json.loads(line) )
+            except ValueError:
+                break
+    return events
+
+
+def Timing():
+    return {'query':0.0, 'fetch':0.0, 'wait':0.0, 'write':0.0, 'rows':0, 'bytes':0, 'pieces':0}
+
+
+def Timed(pieces, timing):
+    # 'query' is the time to the first piece (execute plus first fetch), 'fetch' the time for the rest
+    t = time.time()
+    for data, last in pieces:
+        if timing['pieces']==0:
+            timing['query'] += time.time() - t
+        else:
+            timing['fetch'] += time.time() - t
+        timing['pieces'] += 1
+        timing['rows'] += len(data)
+        timing['bytes'] += data.nbytes
+        yield data, last
+        t = time.time()
+
+
+def Summary(events, wall, slowest=10):
+    outputs = [e for e in events if e['event']=='output']
+    chunks = [e for e in events if e['event']=='chunk']
+    ranks = [e for e in events if e['event']=='rank']
+
+    rows = sum([e['rows'] for e in outputs])
+    print 'run: %i chunks, %i rows, %.1f MB in %.1f s, %.0f rows/s' %(len(chunks), rows, sum([e['bytes'] for e in outputs])/1024.0**2, wall, rows/max(wall,1e-9))
+
+    for num in range(len(names)):
+        out = [e for e in outputs if e['num']==num]
+        if len(out)==0:
+            continue
+        s = dict( [(key, sum([e[key] for e in out])) for key in ['rows', 'bytes', 'query', 'fetch', 'wait', 'write']] )
+        print '%6s: %10i rows %9.1f MB  query %8.1f s  fetch %8.1f s  lock wait %8.1f s  write %8.1f s' %(names[num], s['rows'], s['bytes']/1024.0**2, s['query'], s['fetch'], s['wait'], s['write'])
+
+    writers = [e for e in events if e['event']=='writer']
+    for num in range(len(names)):
+        w = [e for e in writers if e['num']==num]
+        raw = sum([e['raw'] for e in w])
+        stored = sum([e['stored'] for e in w])
+        if (raw > 0) and (stored!=raw):
+            print '%6s: %9.1f MB fetched, %9.1f MB stored, %.0f%% saved by narrowing' %(names[num], raw/1024.0**2, stored/1024.0**2, 100.0*(raw-stored)/raw)
+
+    wait = np.array([e['wait'] for e in outputs])
+    write = np.array([e['write'] for e in outputs])
+    if len(wait) > 0:
+        print 'lock contention: %.1f s waiting vs %.1f s writing (%.0f%%), longest wait %.2f s' %(np.sum(wait), np.sum(write), 100.0*np.sum(wait)/max(np.sum(wait)+np.sum(write),1e-9), np.amax(wait))
+
+    for e in sorted(ranks, key=lambda e: e['rank']):
+        r = [c for c in chunks if c['rank']==e['rank']]
+        print 'rank %4i: %5i chunks %10i rows  busy %.0f%% of %.1f s' %(e['rank'], len(r), sum([c['rows'] for c in r]), 100.0*(1-e['idle']/max(e['wall'],1e-9)), e['wall'])
+
+    print 'slowest chunks:'
+    for e in sorted(chunks, key=lambda e: -e['seconds'])[:slowest]:
+        print '  %s %.1f s %i rows (rank %i)' %(e['chunk'], e['seconds'], e['rows'], e['rank'])
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+import re
+import sys
+import time
+
+import DownloadDB
+import Index
+
+
+# Checks, before a big DownloadDB run, that its chunk queries use the indexes Index.py builds: the same
+# Schedule() and Query() as a run, then EXPLAIN PLAN on a few sample chunks and a timed fetch of each.
+def SetupParser():
+    parser = DownloadDB.SetupParser()
+    parser.add_argument( "-n", "--indexname", help="Base string of Index.py's index names", default=None)
+    parser.add_argument( "-ns", "--nsample", help="Sample chunks to explain and time", default=4, type=int)
+    parser.add_argument( "-nx", "--notime", help="Only explain, do not run the sample queries", action="store_true")
+    return parser
+
+
+def GetArgs():
+    parser = SetupParser()
+    args = DownloadDB.ParseArgs(parser)
+    if args.indexname is None:
+        args.indexname = Index.IndexName(args.table)
+    args.done = [set(), set(), set(), set()]
+    return args
+
+
+def Samples(chunks, n):
+    # The biggest chunk, a split tile, a batch of small tiles, a typical one and the smallest
+    picks = [chunks[0]]
+    picks += [c for c in chunks if c['range'] is not None][:1]
+    picks += [c for c in chunks if len(c['tiles']) > 1][:1]
+    picks += [chunks[len(chunks)/2], chunks[-1]]
+    samples = []
+    for chunk in picks:
+        if DownloadDB.Label(chunk) not in [DownloadDB.Label(c) for c in samples]:
+            samples.append(chunk)
+    return samples[:n]
+
+
+def Plan(args, cur, q, id):
+    # (operation, object) rows of the execution plan
+    if args.fakedb is not None:
+        # SQLite names the query's aliases, not its tables
+        aliases = {}
+        for source in re.search(r' from (.*?) where ', q).group(1).split(','):
+            table, alias = source.split()
+            aliases[alias] = table.split('.')[-1]
+        plan = []
+        for detail in cur.quick('explain query plan %s'%(q), array=True)['detail']:
+            words = [word for word in detail.split() if word!='TABLE']
+            if words[0]=='SCAN':
+                plan.append( ('TABLE ACCESS FULL', aliases.get(words[1], words[1]).upper()) )
+            elif 'INDEX' in words:
+                plan.append( ('INDEX', words[words.index('INDEX')+1].upper()) )
+        return plan
+
+    cur.quick("delete from plan_table where statement_id='%s'"%(id))
+    cur.quick("explain plan set statement_id='%s' for %s"%(id, q))
+    arr = cur.quick("select operation, options, object_name from plan_table where statement_id='%s' order by id"%(id), array=True)
+    cur.quick("delete from plan_table where statement_id='%s'"%(id))
+    cur.commit()
+    return [('%s %s'%(op, opt), obj) for op, opt, obj in zip(arr['operation'], arr['options'], arr['object_name'])]
+
+
+def Check(args, num, plan):
+    # A full scan of a Balrog table, or a plan that touches none of Index.py's indexes, is flagged
+    tables = [args.truth, args.sim, args.nosim]
+    full = [obj for op, obj in plan if op.startswith('TABLE ACCESS FULL') and obj.lower() in tables]
+    if num==3:
+        return 'ok', []
+    names = [name.upper() for names in Index.Expected(args.table, args.indexname) for name in names]
+    used = [obj for op, obj in plan if (obj is not None) and (obj.upper() in names)]
+    if len(full) > 0:
+        return 'FULL SCAN of %s'%(', '.join(full)), used
+    if len(used)==0:
+        return 'no expected index', used
+    return 'ok', used
+
+
+def Time(args, cur, q):
+    t = time.time()
+    n = 0
+    for data, last in DownloadDB.Fetch(args, cur, q):
+        n += len(data)
+    return n, time.time() - t
+
+
+if __name__=='__main__':
+    args = GetArgs()
+    cur = DownloadDB.Connect(args)
+    chunks = DownloadDB.Schedule(args, cur)
+    print '%i chunks, explaining %i' %(len(chunks), min(args.nsample, len(chunks)))
+
+    names = ['truth', 'sim', 'nosim', 'des']
+    bad = 0
+    for chunk in Samples(chunks, args.nsample):
+        label = DownloadDB.Label(chunk)
+        for num in range(len(args.file)):
+            tiles = DownloadDB.Todo(args, chunk, num)
+            if len(tiles)==0:
+                continue
+            q = DownloadDB.Query(args, num, chunk, tiles, local=args.localjoin)
+            plan = Plan(args, cur, q, 'balrog_%i'%(num))
+            status, used = Check(args, num, plan)
+            if status!='ok':
+                bad += 1
+            line = '%s %s: %s, indexes %s' %(label, names[num], status, ', '.join(used) or '-')
+            if not args.notime:
+                n, t = Time(args, cur, q)
+                line = '%s, %i rows in %.2f s (%.0f rows/s)' %(line, n, t, n/max(t,1e-9))
+            print line
+
+    if bad > 0:
+        print '%i sample queries do not use the expected indexes' %(bad)
+        sys.exit(1)
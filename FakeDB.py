@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+import re
+import sqlite3
+import numpy as np
+
+import cx_Oracle
+
+
+# A stand-in for desdb's connection backed by a SQLite file, for benchmarking without the DB server.
+# It understands the Oracle-isms the scripts here send (owner.table names, unique(), partition clauses,
+# bitmap join indexes, DBMS_STATS) well enough to run them, not in general.
+def connect(file):
+    return Connection(file)
+
+
+class Connection(object):
+
+    def __init__(self, file):
+        # Many ranks share the file; writers wait for each other instead of failing
+        self.db = sqlite3.connect(file, timeout=600)
+        self.Types()
+
+    def Types(self):
+        self.types = {}
+        self.tables = [str(name) for name, in self.db.execute("select name from sqlite_master where type='table'")]
+        for table in self.tables:
+            for row in self.db.execute("pragma table_info(%s)"%(table)):
+                self.types[str(row[1]).lower()] = DType(row[2])
+
+    def quick(self, q, array=True):
+        curs = self.cursor()
+        curs.execute(q)
+        if curs.curs.description is None:
+            if re.match(r'\s*(create|drop|alter)', q, re.IGNORECASE):
+                self.Types()
+            return None
+        rows = curs.fetchall()
+        dtype = curs.DType(rows)
+        if array:
+            return np.array(rows, dtype=dtype)
+        return rows
+
+    def cursor(self):
+        return Cursor(self)
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class Cursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.curs = conn.db.cursor()
+        self.arraysize = 1
+
+    def execute(self, q):
+        self.curs.execute( Rewrite(q, self.conn.tables) )
+
+    @property
+    def description(self):
+        # Shaped like cx_Oracle's: (name, type, display_size, internal_size, precision, scale, null_ok)
+        descr = []
+        for name, dtype in self.DType([]):
+            if dtype.startswith('S'):
+                descr.append( (name.upper(), cx_Oracle.STRING, None, int(dtype[1:]), 0, 0, 1) )
+            elif dtype=='i8':
+                descr.append( (name.upper(), cx_Oracle.NUMBER, None, 22, 12, 0, 1) )
+            else:
+                descr.append( (name.upper(), cx_Oracle.NATIVE_FLOAT, None, 8, 0, 0, 1) )
+        return descr
+
+    def DType(self, rows):
+        # Declared column types where the name is a table column, otherwise guessed from the values
+        dtype = []
+        for i in range(len(self.curs.description)):
+            name = str(self.curs.description[i][0]).lower()
+            if name in self.conn.types:
+                dtype.append( (name, self.conn.types[name]) )
+                continue
+            values = [row[i] for row in rows if row[i] is not None]
+            if any([isinstance(v, basestring) for v in values]):
+                dtype.append( (name, 'S%i'%(max([len(v) for v in values]))) )
+            elif all([isinstance(v, (int, long)) for v in values]) and (len(values) > 0):
+                dtype.append( (name, 'i8') )
+            else:
+                dtype.append( (name, 'f8') )
+        return dtype
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        return Rows( self.curs.fetchmany(size) )
+
+    def fetchall(self):
+        return Rows( self.curs.fetchall() )
+
+    def close(self):
+        self.curs.close()
+
+
+def Rows(rows):
+    # SQLite hands back unicode text and NULLs, numpy wants str and numbers
+    out = []
+    for row in rows:
+        out.append( tuple([v.encode('ascii') if isinstance(v, unicode) else (np.nan if v is None else v) for v in row]) )
+    return out
+
+
+def DType(decl):
+    decl = decl.lower().replace(' ', '')
+    m = re.match(r'(varchar2?|char)\((\d+)\)', decl)
+    if m is not None:
+        return 'S%s'%(m.group(2))
+    m = re.match(r'number\((\d+)(,(\d+))?\)', decl)
+    if m is not None:
+        if (m.group(3) is None) or (int(m.group(3))==0):
+            return 'i8'
+        return 'f8'
+    if decl.startswith('int'):
+        return 'i8'
+    return 'f8'
+
+
+def Rewrite(q, tables):
+    q = q.strip().rstrip(';')
+
+    # DBMS_STATS calls become a plain analyze
+    if re.match(r'begin\s+dbms_stats', q, re.IGNORECASE):
+        return 'analyze'
+
+    m = re.match(r"select table_name from dba_tables where owner='(\w*)'", q, re.IGNORECASE)
+    if m is not None:
+        return "select upper(name) table_name from sqlite_master where type='table'"
+
+    # Keys built on an existing unique index, and index degree changes, need nothing here
+    if re.match(r'alter table \w+ add constraint \w+ primary key \([\w, ]+\) using index', q, re.IGNORECASE) or re.match(r'alter index', q, re.IGNORECASE):
+        return 'analyze'
+    m = re.match(r'alter table (\w+) add constraint (\w+) primary key \(([\w, ]+)\)', q, re.IGNORECASE)
+    if m is not None:
+        return 'create unique index %s on %s (%s)'%(m.group(2), m.group(1), m.group(3))
+    m = re.match(r'alter table (\w+) drop constraint (\w+)', q, re.IGNORECASE)
+    if m is not None:
+        return 'drop index %s'%(m.group(2))
+
+    # SQLite has no bitmap join index; index the joined column on its own table instead
+    m = re.match(r'create bitmap index (\w+) on \w+\s*\((\w+)\.(\w+)\)', q, re.IGNORECASE)
+    if m is not None:
+        return 'create index %s on %s (%s)'%(m.group(1), m.group(2), m.group(3))
+    q = re.sub(r'create bitmap index', 'create index', q, flags=re.IGNORECASE)
+    q = re.sub(r'(\s+(local|online|nologging|parallel(\s+\d+)?|compute statistics))+\s*$', '', q, flags=re.IGNORECASE)
+
+    q = re.sub(r'\s*partition by range\s*\(.*$', '', q, flags=re.IGNORECASE|re.DOTALL)
+    q = re.sub(r'\bunique\s*\(([^)]*)\)', r'distinct \1', q, flags=re.IGNORECASE)
+    q = re.sub(r'\s+sample\s*\([\d.e+-]+\)', ' ', q, flags=re.IGNORECASE)
+    for table in tables:
+        q = re.sub(r'\b\w+\.(%s)\b'%(table), r'\1', q, flags=re.IGNORECASE)
+    return q
+
+
+def ColumnDescribe(conn, table):
+    # Shaped like suchyta_utils.db.ColumnDescribe, for seeding a schema cache
+    rows = []
+    for cid, name, decl, notnull, default, pk in conn.db.execute("pragma table_info(%s)"%(table)):
+        decl = decl.lower().replace(' ', '')
+        m = re.match(r'(\w+)(\((\d+)(,(\d+))?\))?', decl)
+        type, p1, p2 = m.group(1), m.group(3), m.group(5)
+        length = 0
+        if type in ['varchar2', 'varchar', 'char']:
+            length = int(p1)
+            p1 = None
+        rows.append( (str(name).upper(), type.upper(), int(p1 or 0), int(p2 or 0), ['Y','N'][notnull], length) )
+    return np.array(rows, dtype=[('column_name','S30'), ('data_type','S30'), ('data_precision','i8'), ('data_scale','i8'), ('nullable','S1'), ('char_length','i8')])
+
+
+def IndexDescribe(conn, table):
+    names = [str(name).upper() for name, in conn.db.execute("select name from sqlite_master where type='index' and tbl_name='%s'"%(table))]
+    return np.array(names, dtype=[('index_name','S30')])
+
+
+def ConstraintDescribe(conn, table):
+    # Primary keys are emulated with unique indexes, see Rewrite
+    names = [str(name).upper() for name, in conn.db.execute("select name from sqlite_master where type='index' and tbl_name='%s' and sql like 'create unique%%'"%(table))]
+    return np.array(names, dtype=[('constraint_name','S30')])
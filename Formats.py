@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+
+import os
+import json
+import shutil
+import numpy as np
+
+import fitsio
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+# The manifest beside each output is also its row index: one JSON line per finished chunk with the
+# table, chunk key, tile, the row ranges it occupies and (truth/sim/nosim) its balrog_id range.
+def ManifestFile(file):
+    return '%s.manifest'%(file)
+
+
+def ReadManifest(file):
+    entries = []
+    mfile = ManifestFile(file)
+    if os.path.exists(mfile):
+        for line in open(mfile):
+            # A crash can leave a torn final line; everything before it is still valid
+            try:
+                entries.append( json.loads(line) )
+            except ValueError:
+                break
+    return entries
+
+
+def AddManifest(file, entries, mode='a'):
+    WriteEntries(ManifestFile(file), entries, mode)
+
+
+def WriteEntries(mfile, entries, mode):
+    m = open(mfile, mode)
+    for entry in entries:
+        m.write('%s\n'%(json.dumps(entry)))
+    m.flush()
+    os.fsync(m.fileno())
+    m.close()
+
+
+def StagedManifest(file):
+    return '%s.tmp'%(ManifestFile(file))
+
+
+def StageManifest(file, entries):
+    # The manifest of a rewritten copy of file, put in place by Replace()
+    WriteEntries(StagedManifest(file), entries, 'w')
+
+
+def Replace(file, new):
+    # Swaps in a rewritten copy of file and its staged manifest. After staging this only renames, so calling
+    # it again after a crash finishes the swap. Directories (.cols) cannot be renamed over and go first.
+    mfile = StagedManifest(file)
+    if not os.path.exists(mfile):
+        return False
+    if os.path.exists(new):
+        if Type(file)=='.cols':
+            Remove(file)
+        os.rename(new, file)
+    os.rename(mfile, ManifestFile(file))
+    return True
+
+
+def AddRows(entry, start, count):
+    if (len(entry['rows']) > 0) and (sum(entry['rows'][-1])==start):
+        entry['rows'][-1][1] += count
+    else:
+        entry['rows'].append([start, count])
+
+
+def Type(file):
+    return os.path.splitext(file)[1]
+
+
+def Open(file, mode='rw'):
+    if Type(file)=='.h5':
+        if h5py is None:
+            raise ImportError('h5py is needed to read or write %s'%(file))
+        return h5py.File(file, {'r':'r', 'rw':'a'}[mode])
+    if Type(file)=='.cols':
+        return OpenCols(file, mode)
+    return fitsio.FITS(file, mode)
+
+
+def Close(f):
+    if IsCols(f):
+        CloseCols(f)
+    else:
+        f.close()
+
+
+def Flush(f):
+    # Puts what was appended through a handle that stays open on disk
+    if IsCols(f):
+        CloseCols(f)
+    elif IsH5(f):
+        f.flush()
+    else:
+        f.reopen()
+
+
+def Sync(file):
+    files = [file]
+    if Type(file)=='.cols':
+        files = [os.path.join(file, name) for name in os.listdir(file)] + files
+    for file in files:
+        fd = os.open(file, os.O_RDONLY)
+        os.fsync(fd)
+        os.close(fd)
+
+
+def Remove(file):
+    if os.path.isdir(file):
+        shutil.rmtree(file)
+    elif os.path.exists(file):
+        os.remove(file)
+
+
+def IsH5(f):
+    return (h5py is not None) and isinstance(f, h5py.File)
+
+
+def IsCols(f):
+    return isinstance(f, dict)
+
+
+def OpenCols(file, mode):
+    # A directory with one raw binary file per column and a JSON schema giving dtypes, row count and keys
+    schema = {'columns':[], 'nrows':0, 'keys':{}}
+    sfile = os.path.join(file, 'schema.json')
+    if os.path.exists(sfile):
+        schema = json.load( open(sfile) )
+    elif mode=='r':
+        raise IOError('%s is not a column catalog'%(file))
+    elif not os.path.exists(file):
+        os.makedirs(file)
+    return {'file':file, 'mode':mode, 'schema':schema}
+
+
+def CloseCols(f):
+    if f['mode']=='rw':
+        sfile = os.path.join(f['file'], 'schema.json')
+        s = open('%s.tmp'%(sfile), 'w')
+        json.dump(f['schema'], s)
+        s.close()
+        os.rename('%s.tmp'%(sfile), sfile)
+
+
+def ColumnFile(f, name):
+    return os.path.join(f['file'], '%s.bin'%(name))
+
+
+def Column(f, name):
+    # Zero-copy, read-only view of one column of a .cols catalog
+    dtype = np.dtype( dict(f['schema']['columns'])[name] )
+    nrows = f['schema']['nrows']
+    if nrows==0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(ColumnFile(f, name), dtype=dtype, mode='r', shape=(nrows,))
+
+
+def WriteColumn(f, name, data, start):
+    # Writes at the row offset, so bytes left past the schema's row count by a crash are overwritten
+    file = ColumnFile(f, name)
+    if not os.path.exists(file):
+        open(file, 'wb').close()
+    c = open(file, 'r+b')
+    c.seek(start*data.dtype.itemsize)
+    c.write( np.ascontiguousarray(data).tostring() )
+    c.truncate()
+    c.close()
+
+
+def Columns(f):
+    if IsCols(f):
+        return [name for name, dtype in f['schema']['columns']]
+    if IsH5(f):
+        if 'columns' not in f.attrs:
+            return []
+        return json.loads(f.attrs['columns'])
+    if len(f) < 2:
+        return []
+    return f[1].get_colnames()
+
+
+def NumRows(f):
+    if IsCols(f):
+        return f['schema']['nrows']
+    if IsH5(f):
+        columns = Columns(f)
+        if len(columns)==0:
+            return 0
+        return len(f[columns[0]])
+    if len(f) < 2:
+        return 0
+    return f[1].get_nrows()
+
+
+def Append(f, data, compress=None, chunkrows=65536, shuffle=False):
+    start = NumRows(f)
+    if IsCols(f):
+        if len(Columns(f))==0:
+            f['schema']['columns'] = [(name, data.dtype[name].str) for name in data.dtype.names]
+        for name in Columns(f):
+            WriteColumn(f, name, data[name], start)
+        f['schema']['nrows'] = start + len(data)
+    elif IsH5(f):
+        # One chunked, resizable dataset per column, so readers only touch the columns they ask for
+        if len(Columns(f))==0:
+            for name in data.dtype.names:
+                f.create_dataset(name, shape=(0,), maxshape=(None,), dtype=data.dtype[name], chunks=(chunkrows,), compression=compress, shuffle=shuffle)
+            f.attrs['columns'] = json.dumps(list(data.dtype.names))
+        for name in Columns(f):
+            f[name].resize( (start+len(data),) )
+            f[name][start:] = data[name]
+    elif len(f) < 2:
+        f.write(data)
+    else:
+        f[1].append(data)
+    return start
+
+
+def DType(f):
+    # Of the rows in the file, None before the first append
+    if len(Columns(f))==0:
+        return None
+    if IsCols(f):
+        return np.dtype( [(str(name), str(dtype)) for name, dtype in f['schema']['columns']] )
+    if IsH5(f):
+        return np.dtype( [(name, f[name].dtype) for name in Columns(f)] )
+    return f[1].get_rec_dtype()[0]
+
+
+def Filters(f):
+    # Append() settings that reproduce an HDF5 output's compression
+    if (not IsH5(f)) or (len(Columns(f))==0):
+        return {}
+    d = f[Columns(f)[0]]
+    return {'compress':d.compression, 'shuffle':d.shuffle, 'chunkrows':d.chunks[0]}
+
+
+def Size(file):
+    # Bytes on disk
+    if os.path.isdir(file):
+        return sum([os.path.getsize(os.path.join(file, name)) for name in os.listdir(file)])
+    return os.path.getsize(file)
+
+
+def Read(f, start=0, stop=None, columns=None):
+    if stop is None:
+        stop = NumRows(f)
+    if IsH5(f) or IsCols(f):
+        if columns is None:
+            columns = Columns(f)
+        if IsCols(f):
+            cols = dict( [(name, Column(f, name)) for name in columns] )
+        else:
+            cols = f
+        data = np.empty(stop-start, dtype=[(name, cols[name].dtype) for name in columns])
+        for name in columns:
+            data[name] = cols[name][start:stop]
+        return data
+    if columns is None:
+        return f[1][start:stop]
+    return f[1][columns][start:stop]
+
+
+def Resize(f, nrows):
+    if IsCols(f):
+        for name, dtype in f['schema']['columns']:
+            c = open(ColumnFile(f, name), 'r+b')
+            c.truncate( nrows*np.dtype(dtype).itemsize )
+            c.close()
+        f['schema']['nrows'] = nrows
+    elif IsH5(f):
+        for name in Columns(f):
+            f[name].resize( (nrows,) )
+    else:
+        f[1].resize(nrows)
+
+
+def DeleteRows(f, rows):
+    if IsH5(f) or IsCols(f):
+        keep = np.ones(NumRows(f), dtype=np.bool_)
+        keep[rows] = False
+        for name in Columns(f):
+            if IsCols(f):
+                WriteColumn(f, name, np.array(Column(f, name)[keep]), 0)
+            else:
+                col = f[name][:][keep]
+                f[name].resize( (len(col),) )
+                f[name][:] = col
+        if IsCols(f):
+            f['schema']['nrows'] = int( np.sum(keep) )
+    else:
+        f[1].delete_rows(rows)
+
+
+def GetKey(f, key):
+    if IsCols(f):
+        return f['schema']['keys'][key]
+    if IsH5(f):
+        return f.attrs[key]
+    return f[1].read_header()[key]
+
+
+def SetKey(f, key, value):
+    if IsCols(f):
+        f['schema']['keys'][key] = np.array(value).tolist()
+    elif IsH5(f):
+        f.attrs[key] = value
+    else:
+        f[1].write_key(key, value)
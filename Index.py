@@ -2,22 +2,32 @@
 
 import sys
 import argparse
+import threading
+import Queue
 import desdb
 import suchyta_utils.db
 import numpy as np
 
+import FakeDB
+
 def SetupParser():
     parser = argparse.ArgumentParser()
     parser.add_argument( "-t", "--table", help="DB table name to download", required=True)
     parser.add_argument( "-n", "--indexname", help="base string for index name", default=None)
     parser.add_argument( "-d", "--drop", help="Drop instead of create", action="store_true")
     parser.add_argument( "-l", "--local", help="Local bitmap index", action="store_true")
+    parser.add_argument( "-s", "--sessions", help="DB sessions building indexes at the same time", default=4, type=int)
+    parser.add_argument( "-pa", "--parallel", help="PARALLEL degree for each build and for the stats (0 for none)", default=0, type=int)
+    parser.add_argument( "-on", "--online", help="Build B-tree indexes ONLINE, so the tables stay writable (not possible for bitmap join indexes)", action="store_true")
+    parser.add_argument( "-nl", "--nologging", help="Build with NOLOGGING", action="store_true")
+    parser.add_argument( "-dr", "--dry-run", help="Print the plan and estimated index sizes without running anything", action="store_true")
+    parser.add_argument( "-fd", "--fakedb", help="Run against this SQLite file instead of the DB (see Benchmark.py)", default=None)
     return parser
 
 def ParseArgs(parser):
     args = parser.parse_args()
     if args.indexname is None:
-        args.indexname = 'i_%s'%(args.table.lstrip("balrog_"))
+        args.indexname = IndexName(args.table)
     return args
 
 def GetArgs():
@@ -26,125 +36,271 @@ def GetArgs():
     return args
 
 
-if __name__=='__main__': 
+def IndexName(table):
+    return 'i_%s'%(table.lstrip("balrog_"))
 
-    args = GetArgs()
+def Expected(table, indexname):
+    # Indexes that can serve DownloadDB's truth, sim and nosim chunk queries (see Plan for the names)
+    truth = ['%s_truth_p'%(table), '%s_tt'%(indexname), '%s_tb'%(indexname)]
+    sim = ['%s_j%s'%(indexname, c) for c in ['b','t']] + ['%s_s%s'%(indexname, c) for c in ['b','t']]
+    nosim = ['%s_n%s'%(indexname, c) for c in ['b','t']]
+    return [truth, sim, nosim]
+
+
+def Connect(args):
+    if args.fakedb is not None:
+        return FakeDB.connect(args.fakedb)
+    return desdb.connect()
+
+def ConstraintDescribe(args, cur, table):
+    if args.fakedb is not None:
+        return FakeDB.ConstraintDescribe(cur, table)
+    return suchyta_utils.db.ConstraintDescribe(table)
+
+def IndexDescribe(args, cur, table):
+    if args.fakedb is not None:
+        return FakeDB.IndexDescribe(cur, table)
+    return suchyta_utils.db.IndexDescribe(table)
+
+def GetUser(args):
+    if args.fakedb is not None:
+        return 'fakedb'
+    return suchyta_utils.db.GetUser()
+
+
+def Options(args, online=True):
+    opts = ''
+    if args.parallel > 0:
+        opts = '%s parallel %i'%(opts, args.parallel)
+    if args.online and online:
+        opts = '%s online'%(opts)
+    if args.nologging:
+        opts = '%s nologging'%(opts)
+    return opts
+
+
+def Build(args, cmd, iname):
+    # A parallel build leaves the index with that degree, which would make later queries go parallel
+    cmds = [cmd]
+    if args.parallel > 0:
+        cmds.append( 'ALTER INDEX %s NOPARALLEL'%(iname) )
+    return cmds
+
+
+def Step(name, table, cmds, after=[], kind='index', columns=[]):
+    return {'name':name, 'table':table, 'cmds':cmds, 'after':after, 'kind':kind, 'columns':columns}
+
+
+def Plan(args, cur):
+    # Every missing (or, with --drop, present) constraint and index, with what each one has to wait for
     tables = ['truth', 'sim', 'nosim']
     tnames = ['t','s','n']
     columns = ['balrog_index','tilename']
     cnames = ['b','t']
-
-    cur = desdb.connect()
     truth = '%s_%s'%(args.table, tables[0])
     sim = '%s_%s'%(args.table, tables[1])
 
-
-    # Add a primary key for balrog_index in the truth table
-    docmd = False
+    # Bitmap join indexes live on sim, so look for names across all three tables
+    inds = []
+    for tab in tables:
+        inds = inds + [name for name in IndexDescribe(args, cur, '%s_%s'%(args.table, tab))['index_name']]
     ptname = '%s_p'%(truth)
-    cons = suchyta_utils.db.ConstraintDescribe(truth)
-    found = (ptname.upper() in cons['constraint_name'])
-    if args.drop and found:
-        cmd = "ALTER TABLE %s DROP CONSTRAINT %s" %(truth,ptname)
-        docmd = True
-    elif (not args.drop) and (not found):
-        cmd = "ALTER TABLE %s ADD CONSTRAINT %s PRIMARY KEY (balrog_index)" %(truth,ptname)
-        docmd = True
-    if docmd:
-        print cmd
-        cur.quick(cmd)
-
-    """
-    docmd = False
-    psname = '%s_p'%(sim)
-    cons = suchyta_utils.db.ConstraintDescribe(sim)
-    found = (psname.upper() in cons['constraint_name'])
-    if args.drop and found:
-        cmd = "ALTER TABLE %s DROP CONSTRAINT %s" %(sim,psname)
-        docmd = True
-    elif (not args.drop) and (not found):
-        cmd = "ALTER TABLE %s ADD CONSTRAINT %s PRIMARY KEY (balrog_index, number_sex)" %(sim,psname)
-        docmd = True
-    if docmd:
-        print cmd
-        cur.quick(cmd)
-    """
-    
-    added = {}
-    added['index'] = []
-    added['table'] = []
-
-    # Add indexes in each table on columns
+    cons = ConstraintDescribe(args, cur, truth)
+    pfound = (ptname.upper() in cons['constraint_name'])
+    ifound = (ptname.upper() in inds)
+
+    steps = []
+    if args.drop:
+        joins = []
+        for j in range(len(columns)):
+            iname = '%s_j%s'%(args.indexname,cnames[j])
+            if iname.upper() in inds:
+                steps.append( Step(iname, sim, ['DROP INDEX %s'%(iname)]) )
+                joins.append(iname)
+        if pfound:
+            steps.append( Step(ptname, truth, ["ALTER TABLE %s DROP CONSTRAINT %s DROP INDEX"%(truth,ptname)], after=joins, kind='constraint') )
+        elif ifound:
+            steps.append( Step('%s index'%(ptname), truth, ['DROP INDEX %s'%(ptname)], after=joins) )
+    else:
+        # The primary key gets its own unique index first, so it can be built with the same options
+        after = []
+        if not ifound:
+            steps.append( Step('%s index'%(ptname), truth, Build(args, 'CREATE UNIQUE INDEX %s ON %s (balrog_index)%s'%(ptname, truth, Options(args)), ptname), columns=['balrog_index']) )
+            after = ['%s index'%(ptname)]
+        if not pfound:
+            steps.append( Step(ptname, truth, ["ALTER TABLE %s ADD CONSTRAINT %s PRIMARY KEY (balrog_index) USING INDEX %s"%(truth,ptname,ptname)], after=after, kind='constraint') )
+
     for i in range(len(tables)):
         tname = '%s_%s'%(args.table, tables[i])
-        inds = suchyta_utils.db.IndexDescribe(tname)
-
         for j in range(len(columns)):
+            if (j==0) and (i==0):
+                continue
             iname = '%s_%s%s'%(args.indexname, tnames[i], cnames[j])
-            found = (iname.upper() in inds['index_name'])
-            docmd = False
-
+            found = (iname.upper() in inds)
             if args.drop and found:
-                cmd = 'DROP INDEX %s'%(iname)
-                docmd = True
-            elif (not args.drop) and (not found) and (not ((j==0) and (i==0))):
-                cmd = 'CREATE INDEX %s on %s (%s)'%(iname, tname, columns[j])
-                docmd = True
-                added['table'].append(tname)
-                added['index'].append(iname)
-            if docmd:
-                print cmd
-                cur.quick(cmd)
-  
-
-    # Add an index on joining the truth table and the sim table
-    inds = suchyta_utils.db.IndexDescribe(truth)
-    for j in range(len(columns)):
-        iname = '%s_j%s'%(args.indexname,cnames[j])
-        found = (iname.upper() in inds['index_name'])
-        docmd = False
-
-        if args.drop and found:
-            cmd = "DROP INDEX %s" %(iname)
-            docmd = True
-        elif (not args.drop) and (not found):
+                steps.append( Step(iname, tname, ['DROP INDEX %s'%(iname)]) )
+            elif (not args.drop) and (not found):
+                steps.append( Step(iname, tname, Build(args, 'CREATE INDEX %s on %s (%s)%s'%(iname, tname, columns[j], Options(args)), iname), columns=[columns[j]]) )
+
+    if not args.drop:
+        # Bitmap join indexes need the primary key on truth.balrog_index
+        after = [s['name'] for s in steps if s['name'] in [ptname, '%s index'%(ptname)]]
+        for j in range(len(columns)):
+            iname = '%s_j%s'%(args.indexname,cnames[j])
+            if iname.upper() in inds:
+                continue
+            cmd = "CREATE BITMAP INDEX %s ON %s(%s.%s) FROM %s, %s WHERE %s.balrog_index=%s.balrog_index" %(iname, sim,truth,columns[j], truth,sim, sim,truth)
             if args.local:
-                cmd = "CREATE BITMAP INDEX %s ON %s(%s.%s) FROM %s, %s WHERE %s.balrog_index=%s.balrog_index local" %(iname, sim,truth,columns[j], truth,sim, sim,truth)
+                cmd = '%s local'%(cmd)
+            cmd = '%s%s'%(cmd, Options(args, online=False))
+            steps.append( Step(iname, sim, Build(args, cmd, iname), after=after, kind='bitmap', columns=['%s.%s'%(truth, columns[j])]) )
+    return steps
+
+
+def Waves(steps):
+    # Groups of steps that only depend on earlier groups
+    waves = []
+    done = set()
+    left = list(steps)
+    while len(left) > 0:
+        ready = [s for s in left if all([a in done for a in s['after']])]
+        if len(ready)==0:
+            raise Exception('circular index plan: %s'%(', '.join([s['name'] for s in left])))
+        waves.append(ready)
+        done.update( [s['name'] for s in ready] )
+        left = [s for s in left if s not in ready]
+    return waves
+
+
+def Stats(args, tables):
+    # Once per table with cascade, which covers its indexes too
+    user = GetUser(args)
+    steps = []
+    for table in tables:
+        degree = ''
+        if args.parallel > 0:
+            degree = ', degree => %i'%(args.parallel)
+        cmd = """begin DBMS_STATS.GATHER_TABLE_STATS (ownname => '%s', tabname => '%s', cascade => TRUE%s); end;"""%(user.upper(), table.upper(), degree)
+        steps.append( Step('stats %s'%(table), table, [cmd], kind='stats') )
+    return steps
+
+
+printing = threading.Lock()
+
+def Say(line):
+    printing.acquire()
+    print line
+    sys.stdout.flush()
+    printing.release()
+
+
+def Worker(args, tasks, errors):
+    try:
+        cur = Connect(args)
+    except Exception as e:
+        errors.append(e)
+        return
+    while True:
+        step = tasks.get()
+        if step is None:
+            break
+        try:
+            for cmd in step['cmds']:
+                Say(cmd)
+                cur.quick(cmd)
+            cur.commit()
+        except Exception as e:
+            errors.append( (step['name'], e) )
+
+
+def Run(args, steps):
+    for wave in Waves(steps):
+        tasks = Queue.Queue()
+        errors = []
+        threads = []
+        for step in wave:
+            tasks.put(step)
+        for i in range(min(args.sessions, len(wave))):
+            tasks.put(None)
+            threads.append( threading.Thread(target=Worker, args=(args, tasks, errors)) )
+            threads[-1].start()
+        for thread in threads:
+            thread.join()
+        if len(errors) > 0:
+            raise Exception('index builds failed: %s'%(errors))
+
+
+def Sizes(args, cur, table):
+    # Rows and average column widths from the optimizer stats (None where the table has none)
+    if args.fakedb is not None:
+        n = int( cur.quick('select count(*) n from %s'%(table), array=True)['n'][0] )
+        widths = dict( [(c.lower(), 8) for c in FakeDB.ColumnDescribe(cur, table)['column_name']] )
+        return n, widths
+    user = GetUser(args).upper()
+    arr = cur.quick("select num_rows from all_tables where owner='%s' and table_name='%s'"%(user, table.upper()), array=True)
+    n = None
+    if (len(arr) > 0) and (arr['num_rows'][0]==arr['num_rows'][0]):
+        n = int(arr['num_rows'][0])
+    arr = cur.quick("select column_name, avg_col_len from all_tab_columns where owner='%s' and table_name='%s'"%(user, table.upper()), array=True)
+    widths = dict( [(name.lower(), w) for name, w in zip(arr['column_name'], arr['avg_col_len']) if w==w] )
+    return n, widths
+
+
+def Estimate(args, cur, step, sizes):
+    # B-tree: key plus a 10 byte rowid and ~2 bytes of row overhead per row. Bitmap join: about a bit per
+    # fact row per key, which compresses to far less for low-cardinality keys; taken as key + 1 byte per row.
+    if step['kind'] in ['constraint', 'stats'] or (len(step['columns'])==0):
+        return None
+    if step['table'] not in sizes:
+        sizes[step['table']] = Sizes(args, cur, step['table'])
+    n, widths = sizes[step['table']]
+    width = 0
+    for col in step['columns']:
+        table, col = (['']+col.split('.'))[-2:]
+        if table!='':
+            if table not in sizes:
+                sizes[table] = Sizes(args, cur, table)
+            w = sizes[table][1].get(col)
+        else:
+            w = widths.get(col)
+        if w is None:
+            return None
+        width += w
+    if n is None:
+        return None
+    if step['kind']=='bitmap':
+        return n*(1 + 0.1*width)
+    return n*(width + 12)
+
+
+def DryRun(args, cur, steps):
+    sizes = {}
+    for i, wave in enumerate(Waves(steps)):
+        print 'wave %i (%i at once)' %(i, min(args.sessions, len(wave)))
+        for step in wave:
+            size = Estimate(args, cur, step, sizes)
+            if size is None:
+                size = '?'
             else:
-                cmd = "CREATE BITMAP INDEX %s ON %s(%s.%s) FROM %s, %s WHERE %s.balrog_index=%s.balrog_index" %(iname, sim,truth,columns[j], truth,sim, sim,truth)
-            docmd = True
-            added['table'].append(truth)
-            added['index'].append(iname)
-        if docmd:
-            print cmd
-            cur.quick(cmd)
-        
-        """
-        iname = '%s_js%s'%(args.indexname,cnames[j])
-        found = (iname.upper() in inds['index_name'])
-        docmd = False
-
-        if args.drop and found:
-            cmd = "DROP INDEX %s" %(iname)
-            docmd = True
-        elif (not args.drop) and (not found):
-            cmd = "CREATE BITMAP INDEX %s ON %s(%s.%s) FROM %s, %s WHERE %s.balrog_index=%s.balrog_index" %(iname, truth,sim,columns[j], sim,truth, truth,sim)
-            docmd = True
-        if docmd:
-            print cmd
-            cur.quick(cmd)
-        """
-   
-    cur.commit() 
-    user = suchyta_utils.db.GetUser()
-    utab = np.unique(added['table'])
-    for i in range(len(utab)):
-        cmd = """begin DBMS_STATS.GATHER_TABLE_STATS (ownname => '%s', tabname => '%s'); end;"""%(user.upper(),utab[i].upper())
-        print cmd
-        cur.quick(cmd)
-
-    for i in range(len(added['index'])):
-        cmd = """begin DBMS_STATS.GATHER_INDEX_STATS (ownname => '%s', indname => '%s'); end;"""%(user.upper(),added['index'][i].upper())
-        print cmd
-        cur.quick(cmd)
-    cur.commit() 
+                size = '%.1f MB'%(size/1024.0**2)
+            print '  %s on %s [%s]' %(step['name'], step['table'], size)
+            for cmd in step['cmds']:
+                print '    %s' %(cmd)
+
+
+if __name__=='__main__': 
+
+    args = GetArgs()
+    cur = Connect(args)
+
+    steps = Plan(args, cur)
+    if not args.drop:
+        steps = steps + Stats(args, sorted(set([s['table'] for s in steps])))
+        for s in steps:
+            if s['kind']=='stats':
+                s['after'] = [t['name'] for t in steps if (t['table']==s['table']) and (t['kind']!='stats')]
+
+    if args.dry_run:
+        DryRun(args, cur, steps)
+    else:
+        Run(args, steps)
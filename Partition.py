@@ -14,6 +14,9 @@ import suchyta_utils.db as db
 import suchyta_utils.mpi as mpi
 from mpi4py import MPI
 
+import SchemaCache
+import PartitionTools
+
 
 
 
@@ -24,7 +27,10 @@ def SetupParser():
     parser.add_argument( "-u", "--user", default='suchyta1', help="Username of runner")
     parser.add_argument( "-o", "--out", required=True, help="Out table name")
     parser.add_argument( "-c", "--create", action='store_true', help="Create the partitioned output table")
+    parser.add_argument( "-sd", "--schema", default='schema-cache.json', help="File caching the tables' column descriptions")
+    parser.add_argument( "-rs", "--refresh", action='store_true', help="Describe the tables again instead of trusting the schema cache")
     parser.add_argument( "-off", "--offset", action='store_true', help="Offset balrog_index")
+    parser = PartitionTools.Parser(parser)
     return parser
 
 
@@ -71,68 +77,46 @@ def Recast(tstruct):
         strs.append(s)
     return strs, sels
 
-def Partition():
-    vals = ['12', '23', '33', '43', '53', '61', '68', '75', '82', '90', '301', '317', '329', '341', '349', 'max']
-    ps = []
-    for i in range(len(vals)):
-        if i<(len(vals)-1):
-            ps.append('partition p_y1a1_s82_sim_%s values less than (%s)'%(vals[i], vals[i]))
-        else:
-            ps.append('partition p_y1a1_s82_sim_max values less than (maxvalue)')
-    return ps
-
-
 if __name__=='__main__': 
     args = GetArgs()
-    cur = desdb.connect()
+    cur = PartitionTools.Connect(args)
 
     tables = ['truth','sim','nosim']
     pbys = ['ra', 'alphawin_j2000_i', 'deltawin_j2000_i']
 
 
+    # Rank 0 creates the outputs and plans every insert; the other ranks just run them as they ask
+    tasks = []
     if MPI.COMM_WORLD.Get_rank()==0:
-        sel = "select unique(tilename) tilename from %s.%s_truth"%(args.owner, args.table)
-        tiles = cur.quick(sel, array=True)['tilename']
-    else:
-        tiles = None
-    tiles = mpi.Scatter(tiles)
+        tiles, counts, tmax = PartitionTools.Tiles(cur, '%s.%s_truth'%(args.owner, args.table))
 
+        offset = 0
+        if (args.offset) and (not args.create):
+            m = "select max(balrog_index) offset from %s_truth"%(args.out)
+            offset = cur.quick(m, array=True)['offset'][0] + 1
 
-    offset = 0
-    for tab,pby in zip(tables,pbys):
-        table = '%s_%s'%(args.table,tab)
-        out = '%s_%s'%(args.out,tab)
+        for tab,pby in zip(tables,pbys):
+            table = '%s_%s'%(args.table,tab)
+            out = '%s_%s'%(args.out,tab)
 
-        tstruct = db.ColumnDescribe(table, user=args.owner)
-        types, sels = Recast(tstruct)
-        parts = Partition()
-    
+            tstruct = SchemaCache.Describe(table, user=args.owner, file=args.schema, refresh=args.refresh)
+            types, sels = Recast(tstruct)
 
-        if (MPI.COMM_WORLD.Get_rank()==0):
             if args.create:
+                parts = PartitionTools.Partitions(out, PartitionTools.Boundaries(cur, ['%s.%s'%(args.owner, table)], pby, nparts=args.nparts, rowsperpart=args.rowsperpart, sample=args.sample))
                 arr = cur.quick("select table_name from dba_tables where owner='%s'" %(args.user.upper()), array=True)
-                tables = arr['table_name']
-                if out.upper() in tables:
+                if out.upper() in arr['table_name']:
                     cur.quick('drop table %s'%(out))
                 cur.commit()
                 create = "create table %s (%s)\npartition by range(%s) (%s)"%(out, ', '.join(types), pby, ', '.join(parts))
                 cur.quick(create)
 
-            elif (args.offset) and (tab=='truth'):
-                m = "select max(balrog_index) offset from %s"%(out)
-                offset = cur.quick(m, array=True)['offset'][0] + 1
-        else:
-            offset = None
-        offset = mpi.Broadcast(offset)
-        sels = ', '.join(sels)
-        sels_off = sels.replace('(balrog_index', '(balrog_index+%i'%(offset))
-
-
-        MPI.COMM_WORLD.Barrier()
-        for tile in tiles:
-            sel = "select %s from %s.%s where tilename='%s'"%(sels_off, args.owner, table, tile)
-            ins = 'insert into %s %s'%(out, sel)
-            cur.quick(ins)
-            cur.commit()
-        if (MPI.COMM_WORLD.Get_rank()==0):
-            print table
+            sels = ', '.join(sels)
+            sels_off = sels.replace('(balrog_index', '(balrog_index+%i'%(offset))
+            tasks = tasks + PartitionTools.Tasks(args, out, sels_off, '%s.%s'%(args.owner, table), tiles, counts)
+        tasks = PartitionTools.Order(tasks)
+        print '%i tiles in %i inserts' %(len(tiles), len(tasks))
+
+    PartitionTools.Run(cur, tasks, args.poll)
+    if (MPI.COMM_WORLD.Get_rank()==0):
+        print args.table
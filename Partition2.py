@@ -14,6 +14,9 @@ import suchyta_utils.db as db
 import suchyta_utils.mpi as mpi
 from mpi4py import MPI
 
+import SchemaCache
+import PartitionTools
+
 
 
 
@@ -25,6 +28,9 @@ def SetupParser():
     parser.add_argument( "-u", "--user", default='suchyta1', help="Username of runner")
     parser.add_argument( "-o", "--out", required=True, help="Out table name")
     parser.add_argument( "-c", "--create", action='store_true', help="Create the partitioned output table")
+    parser.add_argument( "-sd", "--schema", default='schema-cache.json', help="File caching the tables' column descriptions")
+    parser.add_argument( "-rs", "--refresh", action='store_true', help="Describe the tables again instead of trusting the schema cache")
+    parser = PartitionTools.Parser(parser)
     return parser
 
 
@@ -79,58 +85,50 @@ def Recast(tstruct):
         strs.append(s)
     return strs, sels
 
-def Partition():
-    vals = ['12', '23', '33', '43', '53', '61', '68', '75', '82', '90', '301', '317', '329', '341', '349', 'max']
-    ps = []
-    for i in range(len(vals)):
-        if i<(len(vals)-1):
-            ps.append('partition p_y1a1_s82_sim_%s values less than (%s)'%(vals[i], vals[i]))
-        else:
-            ps.append('partition p_y1a1_s82_sim_max values less than (maxvalue)')
-    return ps
-
-
 if __name__=='__main__': 
     args = GetArgs()
-    cur = desdb.connect()
+    cur = PartitionTools.Connect(args)
 
     tables = ['truth','sim','nosim']
     pbys = ['ra', 'alphawin_j2000_i', 'deltawin_j2000_i']
 
 
+    # Rank 0 plans every table's offset and inserts up front, so all the source tables load from one queue.
+    # 'last' starts a table after the previous one's balrog_index range, 'out' after everything in the
+    # output so far, anything else reuses the previous offset.
+    tasks = []
     if (MPI.COMM_WORLD.Get_rank()==0):
         offset = 0
-        if (args.offsets[0]=='out'):
+        outmax = -1
+        if ('out' in args.offsets) and ((args.offsets[0]=='out') or (not args.create)):
             t = '%s_truth'%(args.out)
             m = "select max(balrog_index) offset from %s"%(t)
-            offset = cur.quick(m, array=True)['offset'][0] + 1
-
-
-    for i in range(len(args.tables)):
-        args.table = args.tables[i]
-        args.owner = args.owners[i]
-
-        if MPI.COMM_WORLD.Get_rank()==0:
-            sel = "select unique(tilename) tilename from %s.%s_truth"%(args.owner, args.table)
-            tiles = cur.quick(sel, array=True)['tilename']
-        else:
-            tiles = None
-        tiles = mpi.Scatter(tiles)
-
-        if MPI.COMM_WORLD.Get_rank()!=0:
-            offset = None
-        offset = mpi.Broadcast(offset)
-
+            outmax = int(cur.quick(m, array=True)['offset'][0])
+        if (args.offsets[0]=='out'):
+            offset = outmax + 1
+
+        plan = []
+        for i in range(len(args.tables)):
+            tiles, counts, tmax = PartitionTools.Tiles(cur, '%s.%s_truth'%(args.owners[i], args.tables[i]))
+            if i > 0:
+                if (args.offsets[i]=='last'):
+                    offset = offset + plan[-1][3] + 1
+                elif (args.offsets[i]=='out'):
+                    offset = outmax + 1
+            outmax = max(outmax, offset+tmax)
+            plan.append( [tiles, counts, offset, tmax] )
+            print args.tables[i], offset
 
         for tab,pby in zip(tables,pbys):
-            table = '%s_%s'%(args.table,tab)
             out = '%s_%s'%(args.out,tab)
-            tstruct = db.ColumnDescribe(table, user=args.owner)
-            types, sels = Recast(tstruct)
-        
-            if (MPI.COMM_WORLD.Get_rank()==0) and (i==0):
-                if args.create:
-                    parts = Partition()
+            for i in range(len(args.tables)):
+                table = '%s_%s'%(args.tables[i],tab)
+                tstruct = SchemaCache.Describe(table, user=args.owners[i], file=args.schema, refresh=args.refresh)
+                types, sels = Recast(tstruct)
+
+                if (i==0) and (args.create):
+                    sources = ['%s.%s_%s'%(owner, name, tab) for name, owner in zip(args.tables, args.owners)]
+                    parts = PartitionTools.Partitions(out, PartitionTools.Boundaries(cur, sources, pby, nparts=args.nparts, rowsperpart=args.rowsperpart, sample=args.sample))
                     arr = cur.quick("select table_name from dba_tables where owner='%s'" %(args.user.upper()), array=True)
                     table_names = arr['table_name']
                     if out.upper() in table_names:
@@ -139,25 +137,11 @@ if __name__=='__main__':
                     create = "create table %s (%s)\npartition by range(%s) (%s)"%(out, ', '.join(types), pby, ', '.join(parts))
                     cur.quick(create)
 
-            sels = ', '.join(sels)
-            sels_off = sels.replace('(balrog_index', '(balrog_index+%i'%(offset))
-
-            if (args.create) and (i==0):
-                MPI.COMM_WORLD.Barrier()
-
-            for tile in tiles:
-                sel = "select %s from %s.%s where tilename='%s'"%(sels_off, args.owner, table, tile)
-                ins = 'insert into %s %s'%(out, sel)
-                cur.quick(ins)
-                cur.commit()
-
+                tiles, counts, offset, tmax = plan[i]
+                sels = ', '.join(sels)
+                sels_off = sels.replace('(balrog_index', '(balrog_index+%i'%(offset))
+                tasks = tasks + PartitionTools.Tasks(args, out, sels_off, '%s.%s'%(args.owners[i], table), tiles, counts)
+        tasks = PartitionTools.Order(tasks)
+        print '%i inserts from %i tables' %(len(tasks), len(args.tables))
 
-        if (MPI.COMM_WORLD.Get_rank()==0):
-            print args.table, offset
-            if (i < len(args.tables)-1):
-                if (args.offsets[i+1]=='last'): 
-                    m = "select max(balrog_index) offset from %s.%s_truth"%(args.owner,args.table)
-                    offset = offset + int(cur.quick(m, array=True)['offset'][0]) + 1
-                elif (args.offsets[i+1]=='out'):
-                    m = "select max(balrog_index) offset from %s"%(out)
-                    offset = offset + int(cur.quick(m, array=True)['offset'][0]) + 1
+    PartitionTools.Run(cur, tasks, args.poll)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+import time
+import numpy as np
+import desdb
+
+import FakeDB
+from mpi4py import MPI
+
+
+# Shared by Partition.py and Partition2.py: rank 0 plans the insert statements and hands them out one at a
+# time to whichever rank asks next, so a rank stuck on a slow tile does not hold the others up.
+def Connect(args):
+    if args.fakedb is not None:
+        return FakeDB.connect(args.fakedb)
+    return desdb.connect()
+
+
+def Receive(source, poll):
+    if poll > 0:
+        while not MPI.COMM_WORLD.Iprobe(source=source):
+            time.sleep(poll)
+    return MPI.COMM_WORLD.recv(source=source)
+
+
+def Sample(cur, sources, column, sample):
+    values = []
+    for source in sources:
+        q = "select %s v from %s sample(%g) where %s is not null"%(column, source, sample, column)
+        if sample >= 100:
+            q = "select %s v from %s where %s is not null"%(column, source, column)
+        values.append( cur.quick(q, array=True)['v'] )
+    return np.concatenate(values)
+
+
+def Boundaries(cur, sources, column, nparts=16, rowsperpart=0, sample=1.0):
+    # Quantiles of the partition column over all the input tables, so every partition gets about the same rows
+    values = Sample(cur, sources, column, sample)
+    if (len(values) < 100*nparts) and (sample < 100):
+        values = Sample(cur, sources, column, 100)
+        sample = 100
+    if rowsperpart > 0:
+        nparts = int( np.ceil(len(values) * 100.0/sample / rowsperpart) )
+    if (nparts < 2) or (len(values)==0):
+        return []
+    bounds = np.percentile(values, np.linspace(0, 100, nparts+1)[1:-1])
+    bounds = ['%.10g'%(b) for b in bounds]
+    return sorted(set(bounds), key=float)
+
+
+def PartitionName(out, suffix):
+    # Oracle identifiers are at most 30 characters
+    suffix = '_%s'%(suffix)
+    return ('p_%s'%(out))[:(30-len(suffix))] + suffix
+
+
+def Partitions(out, bounds):
+    ps = []
+    for i in range(len(bounds)):
+        ps.append('partition %s values less than (%s)'%(PartitionName(out, '%02i'%(i)), bounds[i]))
+    ps.append('partition %s values less than (maxvalue)'%(PartitionName(out, 'max')))
+    return ps
+
+
+def Quote(tile):
+    return "'%s'"%(tile)
+
+
+def Insert(args, out, sels, source, tiles):
+    # One statement, and one transaction, per --commit tiles
+    ihint = shint = ''
+    if args.direct:
+        ihint = '/*+ append */ '
+    if args.parallel > 0:
+        shint = '/*+ parallel(%s, %i) */ '%(source.split('.')[-1], args.parallel)
+    sel = "select %s%s from %s where tilename in (%s)"%(shint, sels, source, ', '.join([Quote(tile) for tile in tiles]))
+    return 'insert %sinto %s %s'%(ihint, out, sel)
+
+
+def Tiles(cur, source):
+    # Tile sizes (truth rows) and the largest balrog_index of a source table
+    sel = "select tilename, count(*) n, max(balrog_index) m from %s group by tilename"%(source)
+    arr = cur.quick(sel, array=True)
+    order = np.argsort(-arr['n'], kind='mergesort')
+    return arr['tilename'][order].tolist(), arr['n'][order].tolist(), int(np.amax(arr['m']))
+
+
+def Tasks(args, out, sels, source, tiles, counts):
+    # (rows, task) pairs; see Order
+    tasks = []
+    commit = max(args.commit, 1)
+    for i in range(0, len(tiles), commit):
+        tasks.append( (sum(counts[i:(i+commit)]), (out, Insert(args, out, sels, source, tiles[i:(i+commit)]))) )
+    return tasks
+
+
+def Order(tasks):
+    # Biggest inserts first, so the long ones do not end up as stragglers
+    return [task for n, task in sorted(tasks, key=lambda t: -t[0])]
+
+
+def Execute(cur, task):
+    out, ins = task
+    cur.quick(ins)
+    cur.commit()
+
+
+def Serve(tasks, poll):
+    rsize = MPI.COMM_WORLD.size - 1
+    sent = 0
+    rdone = 0
+    while (rdone < rsize):
+        rank = Receive(MPI.ANY_SOURCE, poll)
+        if sent < len(tasks):
+            MPI.COMM_WORLD.send(tasks[sent], dest=rank)
+            sent += 1
+        else:
+            MPI.COMM_WORLD.send(-1, dest=rank)
+            rdone += 1
+
+
+def Work(cur, rank, poll):
+    while True:
+        MPI.COMM_WORLD.send(rank, dest=0)
+        task = Receive(0, poll)
+        if task==-1:
+            break
+        Execute(cur, task)
+
+
+def Run(cur, tasks, poll):
+    # Every rank calls this; tasks only matter on rank 0. Returns once all of them are committed.
+    rank = MPI.COMM_WORLD.Get_rank()
+    if MPI.COMM_WORLD.size==1:
+        for task in tasks:
+            Execute(cur, task)
+    elif rank==0:
+        Serve(tasks, poll)
+    else:
+        Work(cur, rank, poll)
+
+
+def Parser(parser):
+    parser.add_argument( "-fd", "--fakedb", default=None, help="Run against this SQLite file instead of the DB (see Benchmark.py)")
+    parser.add_argument( "-cm", "--commit", default=1, type=int, help="Tiles per insert statement and transaction")
+    parser.add_argument( "-dp", "--direct", action='store_true', help="Direct-path (append hint) inserts; these lock the output table, so use few ranks with --parallel")
+    parser.add_argument( "-pa", "--parallel", default=0, type=int, help="Parallel hint degree for the select side of the inserts (0 for none)")
+    parser.add_argument( "-npt", "--nparts", default=16, type=int, help="Range partitions per output table")
+    parser.add_argument( "-rp", "--rowsperpart", default=0, type=int, help="Target rows per partition, overrides --nparts (0 to use --nparts)")
+    parser.add_argument( "-smp", "--sample", default=1.0, type=float, help="Percent of rows sampled to place the partition boundaries")
+    parser.add_argument( "-p", "--poll", default=0.001, type=float, help="Seconds to sleep between MPI probes while waiting (0 blocks in recv)")
+    return parser
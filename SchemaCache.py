@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+import os
+import json
+import numpy as np
+
+import suchyta_utils.db
+
+
+# ColumnDescribe results saved on disk, one JSON object keyed by user.table, so a job only asks
+# the DB's dictionary views about a table the first time (or when asked to refresh).
+def Key(cat, user=None):
+    if user is None:
+        user = ''
+    return '%s.%s'%(user.lower(), cat.lower())
+
+
+def Load(file):
+    if (file is None) or (not os.path.exists(file)):
+        return {}
+    try:
+        return json.load( open(file) )
+    except ValueError:
+        return {}
+
+
+def Save(file, cache):
+    # Written to a temporary file and renamed so a reader never sees half a cache
+    f = open('%s.tmp'%(file), 'w')
+    json.dump(cache, f)
+    f.close()
+    os.rename('%s.tmp'%(file), file)
+
+
+def ToJson(arr):
+    return {'dtype':[(name, arr.dtype[name].str) for name in arr.dtype.names], 'rows':arr.tolist()}
+
+
+def FromJson(obj):
+    dtype = [(str(name), str(type)) for name, type in obj['dtype']]
+    return np.array([tuple(row) for row in obj['rows']], dtype=dtype)
+
+
+def Describe(cat, user=None, file=None, refresh=False):
+    cache = Load(file)
+    key = Key(cat, user=user)
+    if refresh or (key not in cache):
+        cache[key] = ToJson( suchyta_utils.db.ColumnDescribe(cat, user=user) )
+        if file is not None:
+            Save(file, cache)
+    return FromJson(cache[key])
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+import argparse
+import numpy as np
+import os
+import json
+import numpy.lib.recfunctions as rec
+
+import Formats
+import Catalog
+
+try:
+    import healpy as hp
+except ImportError:
+    hp = None
+
+
+# Optional stage after DownloadDB.py: each output is rewritten in HEALPix (NEST) pixel order and gets a
+# <file>.pixels sidecar mapping every pixel to its row range, so a region query only reads the rows of the
+# pixels it overlaps. The manifest's row ranges are remapped to the new order. Rows appended after the sort
+# (--sync, --append) are past the index's nrows and are always read; anything that removes rows drops it.
+def SetupParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( "-d", "--dir", help="Directory of a DownloadDB.py run", required=True)
+    parser.add_argument( "-n", "--name", help="Output name (--name of the run) if the directory holds several", default=None)
+    parser.add_argument( "-k", "--kinds", help="Outputs to sort", default='truth,sim,nosim,des')
+    parser.add_argument( "-ns", "--nside", help="HEALPix nside of the sort and the index", default=64, type=int)
+    parser.add_argument( "-rd", "--radec", help="Position columns to use, e.g. ra,dec (default: alphawin_j2000/deltawin_j2000 where the output has them, else ra/dec)", default=None)
+    parser.add_argument( "-cr", "--chunkrows", help="Most rows held in memory at a time", default=1000000, type=int)
+    return parser
+
+
+def ParseArgs(parser):
+    args = parser.parse_args()
+    args.kinds = args.kinds.split(',')
+    if args.radec is not None:
+        args.radec = args.radec.split(',')
+    return args
+
+def GetArgs():
+    parser = SetupParser()
+    args = ParseArgs(parser)
+    return args
+
+
+positions = [['alphawin_j2000','deltawin_j2000'], ['alphawin_j2000_i','deltawin_j2000_i'], ['ra','dec']]
+
+def Healpy():
+    if hp is None:
+        raise ImportError('healpy is needed for the HEALPix index')
+    return hp
+
+
+def IndexFile(file):
+    return '%s.pixels'%(file)
+
+
+def ReadIndex(file):
+    # None unless there is an index for the file
+    ifile = IndexFile(file)
+    if not os.path.exists(ifile):
+        return None
+    return json.load( open(ifile) )
+
+
+def WriteIndex(file, index):
+    ifile = IndexFile(file)
+    f = open('%s.tmp'%(ifile), 'w')
+    json.dump(index, f)
+    f.close()
+    os.rename('%s.tmp'%(ifile), ifile)
+
+
+def Sorting(file):
+    base, ext = os.path.splitext(file)
+    return '%s-sorting%s'%(base, ext)
+
+
+def Recover(file):
+    # Finishes a sort that crashed while swapping the sorted file in
+    return Formats.Replace(file, Sorting(file))
+
+
+def Positions(f):
+    names = Formats.Columns(f)
+    for radec in positions:
+        if (radec[0] in names) and (radec[1] in names):
+            return radec
+    raise ValueError('no position columns among %s'%(', '.join(names)))
+
+
+def Pixels(ra, dec, nside):
+    return Healpy().ang2pix(nside, np.radians(90.0-dec), np.radians(ra), nest=True)
+
+
+def Disc(nside, ra, dec, radius):
+    # Pixels touching a cone, radius in degrees
+    h = Healpy()
+    vec = h.ang2vec(np.radians(90.0-dec), np.radians(ra))
+    return h.query_disc(nside, vec, np.radians(radius), inclusive=True, nest=True)
+
+
+def Box(nside, ra=None, dec=None):
+    # Pixels touching an ra/dec box: the dec strip, less the pixels whose centers are too far from the ra range
+    # to reach it (lo > hi in ra wraps through 0). query_strip with nest=True aborts in some healpy versions,
+    # so the strip is taken in RING order and converted.
+    h = Healpy()
+    if dec is None:
+        dec = [-90.0, 90.0]
+    pix = h.ring2nest(nside, h.query_strip(nside, np.radians(90.0-dec[1]), np.radians(90.0-dec[0]), inclusive=True))
+    if (ra is None) or (ra[1] - ra[0] >= 360.0):
+        return pix
+    theta, phi = h.pix2ang(nside, pix, nest=True)
+    pra = np.degrees(phi)
+    pdec = 90.0 - np.degrees(theta)
+    margin = np.degrees( h.max_pixrad(nside) )
+    span = (ra[1] - ra[0]) % 360.0
+    cos = np.cos( np.radians(np.minimum(np.abs(pdec)+margin, 90.0)) )
+    reach = np.where(cos > 1e-3, margin/np.maximum(cos, 1e-3), 360.0)
+    past = (pra - ra[0]) % 360.0
+    near = (past <= span + reach) | (past >= 360.0 - reach)
+    return pix[near]
+
+
+def Region(index, nrows, ra=None, dec=None, disc=None):
+    # Row ranges of the pixels touching a box and/or a cone (ra, dec, radius), plus the unsorted rows appended since
+    pix = None
+    if (ra is not None) or (dec is not None):
+        pix = Box(index['nside'], ra=ra, dec=dec)
+    if disc is not None:
+        dpix = Disc(index['nside'], disc[0], disc[1], disc[2])
+        if pix is None:
+            pix = dpix
+        else:
+            pix = np.intersect1d(pix, dpix)
+
+    pixels = np.array(index['pixels'], dtype=np.int64).reshape(-1, 3)
+    if pix is not None:
+        pixels = pixels[np.in1d(pixels[:,0], pix)]
+    ranges = [[int(start), int(count)] for p, start, count in pixels]
+    return Catalog.Coalesce( ranges + [[index['nrows'], max(nrows-index['nrows'],0)]] )
+
+
+def Plan(file, radec, nside, chunkrows):
+    # Rows per pixel over the whole file, and pixel ranges of about chunkrows rows to sort one at a time
+    f = Formats.Open(file, 'r')
+    nrows = Formats.NumRows(f)
+    counts = {}
+    for start in range(0, nrows, chunkrows):
+        data = Formats.Read(f, start, min(start+chunkrows, nrows), columns=radec)
+        pix, n = np.unique( Pixels(data[radec[0]], data[radec[1]], nside), return_counts=True )
+        for p, c in zip(pix.tolist(), n.tolist()):
+            counts[p] = counts.get(p, 0) + c
+    Formats.Close(f)
+
+    pix = np.array(sorted(counts.keys()), dtype=np.int64)
+    n = np.array([counts[p] for p in pix.tolist()], dtype=np.int64)
+    starts = np.cumsum(n) - n
+    buckets = []
+    for i in range(len(pix)):
+        if (len(buckets)==0) or (starts[i] - starts[buckets[-1]] + n[i] > chunkrows):
+            buckets.append(i)
+    return nrows, pix, n, starts, pix[buckets]
+
+
+def Owners(entries):
+    # Manifest entry number of every row range, for finding the entries' rows again after the sort
+    starts = []
+    for i in range(len(entries)):
+        for start, count in entries[i]['rows']:
+            starts.append( (start, count, i) )
+    starts.sort()
+    return np.array([s[0] for s in starts], dtype=np.int64), np.array([s[0]+s[1] for s in starts], dtype=np.int64), np.array([s[2] for s in starts], dtype=np.int64)
+
+
+def Owner(owners, rows):
+    starts, stops, ids = owners
+    i = np.searchsorted(starts, rows, side='right') - 1
+    owner = np.zeros(len(rows), dtype=np.int64) - 1
+    inside = (i >= 0)
+    inside[inside] = rows[inside] < stops[i[inside]]
+    owner[inside] = ids[i[inside]]
+    return owner
+
+
+def Sort(file, nside=64, radec=None, chunkrows=1000000):
+    # Bucket sort: one pass to count rows per pixel, one to spread the rows over pixel-range bucket files,
+    # then each bucket is sorted in memory and appended to the new file
+    Recover(file)
+    f = Formats.Open(file, 'r')
+    if radec is None:
+        radec = Positions(f)
+    filters = Formats.Filters(f)
+    keys = {}
+    for key in ['newmax', 'max_id']:
+        try:
+            keys[key] = Formats.GetKey(f, key)
+        except KeyError:
+            pass
+    Formats.Close(f)
+    nrows, pix, n, starts, bounds = Plan(file, radec, nside, chunkrows)
+    entries = Formats.ReadManifest(file)
+    owners = Owners(entries)
+
+    tmp = os.path.splitext(Sorting(file))[0]
+    buckets = ['%s-%i.cols'%(tmp, i) for i in range(len(bounds))]
+    for bucket in buckets:
+        Formats.Remove(bucket)
+    f = Formats.Open(file, 'r')
+    for start in range(0, nrows, chunkrows):
+        data = Formats.Read(f, start, min(start+chunkrows, nrows))
+        p = Pixels(data[radec[0]], data[radec[1]], nside)
+        owner = Owner(owners, np.arange(start, start+len(data)))
+        data = rec.append_fields(data, ['spatial_pixel','spatial_entry'], [p, owner], usemask=False)
+        b = np.searchsorted(bounds, p, side='right') - 1
+        for i in np.unique(b):
+            out = Formats.Open(buckets[i], 'rw')
+            Formats.Append(out, data[b==i])
+            Formats.Close(out)
+    Formats.Close(f)
+
+    new = Sorting(file)
+    Formats.Remove(new)
+    out = Formats.Open(new, 'rw')
+    for entry in entries:
+        entry['rows'] = []
+    for bucket in buckets:
+        b = Formats.Open(bucket, 'r')
+        data = Formats.Read(b)
+        Formats.Close(b)
+        data = data[ np.argsort(data['spatial_pixel'], kind='mergesort') ]
+        first = Formats.NumRows(out)
+        Formats.Append(out, rec.drop_fields(data, ['spatial_pixel','spatial_entry'], usemask=False), **filters)
+        Remap(entries, data['spatial_entry'], first)
+        Formats.Remove(bucket)
+    for key in keys.keys():
+        Formats.SetKey(out, key, keys[key])
+    Formats.Close(out)
+    Formats.Sync(new)
+
+    # An old index describes the old order
+    Formats.Remove(IndexFile(file))
+    Formats.StageManifest(file, entries)
+    Formats.Replace(file, new)
+    WriteIndex(file, {'nside':nside, 'nest':True, 'radec':radec, 'nrows':nrows, 'pixels':np.array([pix, starts, n]).T.tolist()})
+    return nrows
+
+
+def Remap(entries, owner, first):
+    # New row ranges of each entry's rows, which are in increasing order within every entry
+    order = np.argsort(owner, kind='mergesort')
+    rows = np.arange(first, first+len(owner))[order]
+    owner = owner[order]
+    for i in np.unique(owner[owner >= 0]).tolist():
+        r = rows[owner==i]
+        breaks = np.where(np.diff(r)!=1)[0] + 1
+        for run in np.split(r, breaks):
+            Formats.AddRows(entries[i], int(run[0]), len(run))
+
+
+if __name__=='__main__':
+    args = GetArgs()
+    files = Catalog.Catalog(args.dir, name=args.name)
+    for kind in args.kinds:
+        if kind not in files:
+            continue
+        nrows = Sort(files[kind], nside=args.nside, radec=args.radec, chunkrows=args.chunkrows)
+        index = ReadIndex(files[kind])
+        print '%s: %i rows sorted into %i pixels (nside %i, %s)' %(files[kind], nrows, len(index['pixels']), args.nside, '/'.join(index['radec']))